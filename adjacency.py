@@ -0,0 +1,221 @@
+import numpy as np
+import torch
+
+
+def _sample_cells(total, k, exclude=None):
+    """Draws k distinct integers from [0, total) uniformly, skipping those
+    for which exclude is true, without materializing the whole range."""
+    if 2 * k > total:
+        cells = np.arange(total, dtype=np.int64)
+        if exclude is not None:
+            cells = cells[~exclude(cells)]
+        return np.sort(cells[np.random.permutation(len(cells))[:k]])
+    chosen = np.zeros([0], dtype=np.int64)
+    while len(chosen) < k:
+        draws = np.random.randint(0, total, size=2 * (k - len(chosen)) + 16).astype(np.int64)
+        if exclude is not None:
+            draws = draws[~exclude(draws)]
+        chosen = np.union1d(chosen, draws)
+    # a random subset of the distinct draws is still uniform
+    return np.sort(chosen[np.random.permutation(len(chosen))[:k]])
+
+
+class Adjacency:
+    """Sparse 0/1 connectivity of shape [num_rows, num_cols] stored as COO.
+
+    In the models an edge [a, b] means that latent a of the inverse flow
+    depends on input b, where inputs are the latents followed by the
+    observations. Edges are unique and sorted by (row, col). Iterating
+    yields [a, b] pairs, so code written against the plain pair lists of
+    the generated models keeps working.
+    """
+
+    def __init__(self, rows, cols, shape):
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        cols = np.asarray(cols, dtype=np.int64).reshape(-1)
+        assert rows.shape == cols.shape
+        self.shape = (int(shape[0]), int(shape[1]))
+        if len(rows) > 0:
+            assert rows.min() >= 0 and rows.max() < self.shape[0]
+            assert cols.min() >= 0 and cols.max() < self.shape[1]
+        keys = np.unique(rows * self.shape[1] + cols)
+        self.rows = keys // self.shape[1]
+        self.cols = keys % self.shape[1]
+
+    @classmethod
+    def from_pairs(cls, pairs, shape=None):
+        pairs = np.asarray(list(pairs), dtype=np.int64).reshape(-1, 2)
+        if shape is None:
+            shape = tuple(pairs.max(axis=0) + 1) if len(pairs) > 0 else (0, 0)
+        return cls(pairs[:, 0], pairs[:, 1], shape)
+
+    @classmethod
+    def coerce(cls, adjacency, shape=None):
+        if isinstance(adjacency, cls):
+            return adjacency
+        return cls.from_pairs(adjacency, shape)
+
+    @classmethod
+    def random(cls, shape, num_edges, self_loops=True):
+        """Uniformly random structure with exactly num_edges edges, which
+        include the diagonal if self_loops is set."""
+        num_rows, num_cols = shape
+        diag = np.arange(min(num_rows, num_cols)) if self_loops else np.zeros([0], dtype=np.int64)
+        k = num_edges - len(diag)
+        total = num_rows * num_cols
+        if k < 0 or k > total - len(diag):
+            raise ValueError("Cannot place {} edges in a {}x{} structure.".format(num_edges, *shape))
+        on_diag = (lambda c: c // num_cols == c % num_cols) if self_loops else None
+        cells = _sample_cells(total, k, on_diag)
+        return cls(np.concatenate([cells // num_cols, diag]),
+                   np.concatenate([cells % num_cols, diag]), shape)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.pairs())
+
+    def __eq__(self, other):
+        return isinstance(other, Adjacency) and self.shape == other.shape \
+            and np.array_equal(self.rows, other.rows) and np.array_equal(self.cols, other.cols)
+
+    def pairs(self):
+        return np.stack([self.rows, self.cols], axis=1).tolist()
+
+    def csr(self):
+        """Returns (indptr, indices) of the row-compressed structure."""
+        indptr = np.zeros(self.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.rows, minlength=self.shape[0]), out=indptr[1:])
+        return indptr, self.cols.copy()
+
+    def crop(self, num_rows, num_cols):
+        keep = (self.rows < num_rows) & (self.cols < num_cols)
+        return Adjacency(self.rows[keep], self.cols[keep], (num_rows, num_cols))
+
+    def indices(self, device=None):
+        """[2, nnz] long tensor of (row, col) indices."""
+        return torch.from_numpy(np.stack([self.rows, self.cols])).to(device)
+
+    def mask(self, dim_out, dim_in, device=None):
+        """Dense [dim_out, dim_in] 0/1 weight mask, edges outside are dropped."""
+        cropped = self.crop(dim_out, dim_in)
+        mask = torch.zeros([dim_out, dim_in], device=device)
+        mask[tuple(cropped.indices(device))] = 1.0
+        return mask
+
+    def union(self, other):
+        assert self.shape == other.shape
+        return Adjacency(np.concatenate([self.rows, other.rows]),
+                         np.concatenate([self.cols, other.cols]), self.shape)
+
+    def compose(self, other):
+        """Structure of the matrix product self @ other: [a, c] is an edge if
+        some [a, b] is in self and [b, c] in other."""
+        assert self.shape[1] == other.shape[0]
+        indptr, indices = other.csr()
+        counts = indptr[self.cols + 1] - indptr[self.cols]
+        # positions of the edges of row self.cols[e] of other, for every edge e
+        starts = np.repeat(indptr[self.cols] - np.cumsum(counts) + counts, counts)
+        return Adjacency(np.repeat(self.rows, counts), indices[starts + np.arange(counts.sum())],
+                         (self.shape[0], other.shape[1]))
+
+    def coloring(self):
+        """Greedy coloring of a square structure for exact diagonal recovery.
+
+        Returns a color per index such that no edge [a, b] with a != b, in
+        either direction, joins two indices of the same color. For a matrix
+        with this structure and a 0/1 probe e of a color, (e^T J)_b = J_bb
+        for every b of the color. Indices with most edges are colored first.
+        """
+        assert self.shape[0] == self.shape[1]
+        off = self.rows != self.cols
+        a = np.concatenate([self.rows[off], self.cols[off]])
+        b = np.concatenate([self.cols[off], self.rows[off]])
+        neighbours = Adjacency(a, b, self.shape).csr()
+        colors = np.full(self.shape[0], -1, dtype=np.int64)
+        for i in np.argsort(-np.diff(neighbours[0]), kind="stable"):
+            taken = colors[neighbours[1][neighbours[0][i]:neighbours[0][i + 1]]]
+            free = np.ones(len(taken) + 1, dtype=bool)
+            free[taken[(taken >= 0) & (taken <= len(taken))]] = False
+            colors[i] = np.argmax(free)
+        return colors
+
+    def faithful_inverse(self, num_latent):
+        """Faithful inverse of a generative model by NaMI (Webb et al., 2018).
+
+        self holds the forward [parent, child] edges over the latents
+        followed by the observations. The moral graph is eliminated latent
+        by latent in topological order, among the candidates the one with
+        the fewest neighbours first (min-degree rather than the min-fill of
+        the paper, which is too slow for large graphs), and every latent
+        depends on its neighbours at the time of its elimination. Returns
+        the structure [num_latent, num_vars] in the convention of the
+        models, with self loops.
+        """
+        assert self.shape[0] == self.shape[1] >= num_latent
+        num_vars = self.shape[0]
+        # moral graph as a dense 0/1 matrix, parents married over every child
+        parents = np.zeros(self.shape, dtype=bool)
+        parents[self.cols, self.rows] = True
+        moral = parents | parents.T
+        for c in np.unique(self.cols):
+            p = np.nonzero(parents[c])[0]
+            moral[np.ix_(p, p)] = True
+        np.fill_diagonal(moral, False)
+
+        waiting = parents[:num_latent, :num_latent].sum(axis=1)
+        eliminated = np.zeros(num_latent, dtype=bool)
+        rows, cols = [np.arange(num_latent)], [np.arange(num_latent)]
+        for _ in range(num_latent):
+            candidates = np.nonzero((waiting == 0) & ~eliminated)[0]
+            if len(candidates) == 0:
+                raise ValueError("Forward structure contains a cycle.")
+            v = candidates[np.argmin(moral[candidates].sum(axis=1))]
+            nbrs = np.nonzero(moral[v])[0]
+            rows.append(np.full(len(nbrs), v))
+            cols.append(nbrs)
+            moral[np.ix_(nbrs, nbrs)] = True
+            moral[nbrs, nbrs] = False
+            moral[v, :] = moral[:, v] = False
+            eliminated[v] = True
+            waiting -= parents[:num_latent, v]
+        return Adjacency(np.concatenate(rows), np.concatenate(cols), (num_latent, num_vars))
+
+    def contains(self, rows, cols):
+        keys = np.asarray(rows, dtype=np.int64) * self.shape[1] + np.asarray(cols, dtype=np.int64)
+        return np.isin(keys, self.rows * self.shape[1] + self.cols)
+
+    def augment(self, to_augment, num_latent, copy_rows=True):
+        """Structure of AugmentedModel: latent to_augment[i] gets the partner
+        num_latent + i, inputs behind the latents are shifted accordingly.
+
+        Partners are connected with their augmented latent in both
+        directions and with each other like the augmented latents are. With
+        copy_rows each partner also depends on the inputs of its latent.
+        """
+        aug = np.asarray(to_augment, dtype=np.int64)
+        k = len(aug)
+        partners = num_latent + np.arange(k)
+        shifted = np.where(self.cols < num_latent, self.cols, self.cols + k)
+        rows = [self.rows, aug, partners]
+        cols = [shifted, partners, aug]
+        if copy_rows:
+            for partner, i in zip(partners, aug):
+                inherited = self.rows == i
+                rows.append(np.full(inherited.sum(), partner))
+                cols.append(shifted[inherited])
+        pi, pj = np.meshgrid(np.arange(k), np.arange(k), indexing="ij")
+        linked = self.contains(aug[pi], aug[pj])
+        rows.append(partners[pi[linked]])
+        cols.append(partners[pj[linked]])
+        return Adjacency(np.concatenate(rows), np.concatenate(cols),
+                         (self.shape[0] + k, self.shape[1] + k))
+
+    def save(self, path):
+        np.savez_compressed(path, rows=self.rows, cols=self.cols, shape=np.asarray(self.shape))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["rows"], f["cols"], tuple(f["shape"]))
@@ -0,0 +1,100 @@
+"""Timings of the flow networks on the graphical models.
+
+Measures one evaluation of the ODE right hand side together with the
+vector-Jacobian product of the divergence estimator and its backward pass,
+which is what every solver step of the training loop costs, and counts
+the tensor allocations of one such evaluation:
+
+    python benchmarks.py > bench_output.txt
+"""
+import argparse
+import time
+
+import torch
+
+from flow import create_batch
+from lib import layers
+from nets import AdaptedODENet, SparseODENet
+from registry import MODELS, create_model
+
+SYNTHETIC = ["synthetic-random-{}-fan_in=2".format(n) for n in (100, 300, 1000)]
+
+
+def rhs_step(diffeq, gmodel, batch_size=100):
+    """Returns a function running one right hand side evaluation with divergence."""
+    odefunc = layers.ODEfunc(diffeq)
+    x = torch.randn(batch_size, gmodel.dim_latent)
+    states = (x, torch.zeros(batch_size, 1))
+    diffeq.conditioned = create_batch(gmodel.sample, batch_size)[1]
+    t = torch.tensor(0.5)
+    e = torch.randn_like(x)
+
+    def step():
+        # every step stands for a solve, the backward frees cached weights
+        odefunc.before_odeint(e)
+        dx, divergence = odefunc(t, states)
+        (dx.sum() + divergence.sum()).backward()
+    return step
+
+
+def time_rhs(step, repeats=20):
+    """Returns the mean seconds per call of step."""
+    for _ in range(3):
+        step()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    return (time.perf_counter() - start) / repeats
+
+
+def count_allocations(step):
+    """Returns the number of tensor allocations of one call of step, or nan
+    if the profiler can not record memory (torch < 1.6)."""
+    step()
+    try:
+        with torch.autograd.profiler.profile(profile_memory=True) as prof:
+            step()
+    except TypeError:
+        return float("nan")
+    return sum(1 for e in prof.function_events if getattr(e, "self_cpu_memory_usage", 0) > 0
+               or getattr(e, "self_cuda_memory_usage", 0) > 0)
+
+
+def networks(gmodel):
+    args = (gmodel.dim_latent, gmodel.dim_condition, gmodel.faithful_adjacency, torch.device("cpu"))
+    return {
+        "fully_connected": AdaptedODENet(gmodel.dim_latent, gmodel.dim_condition),
+        "faithful_dense": SparseODENet(*args, sparse_mode="dense"),
+        "faithful_sparse": SparseODENet(*args, sparse_mode="sparse"),
+        "faithful_auto": SparseODENet(*args, sparse_mode="auto"),
+    }
+
+
+def main(names, batch_size, repeats):
+    columns = ["fully_connected", "faithful_dense", "faithful_sparse", "faithful_auto"]
+    header = "{:40s} {:>6s} {:>8s} ".format("model", "latent", "density") \
+        + " ".join("{:>16s}".format(c) for c in columns)
+    times, allocations = [], []
+    for name in names:
+        gmodel = create_model(name)
+        nets = networks(gmodel)
+        density = nets["faithful_dense"].layers[-1].density
+        steps = [rhs_step(nets[c], gmodel, batch_size) for c in columns]
+        row = "{:40s} {:6d} {:8.3f} ".format(name, gmodel.dim_latent, density)
+        times.append(row + " ".join("{:16.3f}".format(1000 * time_rhs(s, repeats)) for s in steps))
+        allocations.append(row + " ".join("{:16.0f}".format(count_allocations(s)) for s in steps))
+    print("\n".join([header + "   (ms per evaluation)"] + times))
+    print("\n".join([header + "   (allocations per evaluation)"] + allocations))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", nargs="*", default=None)
+    parser.add_argument("--batch_size", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    # ToyData and CircleModel have no graph structure
+    names = args.models or [n for n in sorted(MODELS)
+                            if MODELS[n][0] not in ("models:ToyData", "models:CircleModel")] + SYNTHETIC
+    main(names, args.batch_size, args.repeats)
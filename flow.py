@@ -12,26 +12,30 @@ from tqdm import tqdm
 from toolz import last
 
 import lib.layers as layers
+from lib.layers.cnf import check_backprop_solver
 import math
+import os
 
 from collections import namedtuple
 
 
-def set_cnf_options(model):
-    tol = 1e-5
+def set_cnf_options(model, solver="dopri5", atol=1e-5, rtol=1e-5, solver_options=None,
+                    test_solver="dopri5", test_atol=1e-5, test_rtol=1e-5, test_solver_options=None):
 
     def _set(module):
         if isinstance(module, layers.CNF):
             # Set training settings
-            module.solver = "dopri5"
-            module.atol = tol # args.atol
-            module.rtol = tol # args.rtol
-
+            check_backprop_solver(module.backprop_mode, solver)
+            module.solver = solver
+            module.atol = atol
+            module.rtol = rtol
+            module.solver_options = dict(solver_options or {})
 
             # Set the test settings
-            module.test_solver = "dopri5"
-            module.test_atol = tol
-            module.test_rtol = tol
+            module.test_solver = test_solver
+            module.test_atol = test_atol
+            module.test_rtol = test_rtol
+            module.test_solver_options = dict(test_solver_options or {})
 
         if isinstance(module, layers.ODEfunc):
             module.rademacher = False
@@ -40,31 +44,66 @@ def set_cnf_options(model):
     model.apply(_set)
 
 
-def create_cnf(diffeq, regularization_fns=None):
+def set_tolerances(model, atol, rtol):
+    """Changes the training tolerances of all CNFs in model, see scheduled_tolerances."""
+    def _set(module):
+        if isinstance(module, layers.CNF):
+            module.atol = atol
+            module.rtol = rtol
+    model.apply(_set)
+
+
+def scheduled_tolerances(schedule, step, total_steps, default):
+    """Returns (atol, rtol) of the last [fraction, atol, rtol] entry of schedule
+    whose fraction of total_steps has been reached at step, else default."""
+    tolerances = default
+    for fraction, atol, rtol in sorted(schedule):
+        if step >= int(fraction * total_steps):
+            tolerances = (atol, rtol)
+    return tolerances
+
+
+def create_cnf(diffeq, regularization_fns=None, scripted=False, divergence_fn="approximate",
+               num_probes=1, probe="gaussian", solver_settings=None, backprop_mode="adjoint",
+               memory_budget=None):
+    """solver_settings are keyword arguments of set_cnf_options, by default
+    dopri5 with atol = rtol = 1e-5 for training and test. backprop_mode and
+    memory_budget (bytes) choose between the adjoint and direct backprop, see CNF."""
 
     # inlined args default values
-    solver = "dopri5"
-    divergence_function = "approximate" #"brute_force" # TODO?
     residual = False
     rademacher = False
     time_length = 1.0
     train_T = True # TODO
 
-    odefunc = layers.ODEfunc(
-        diffeq=diffeq,
-        divergence_fn=divergence_function,
-        residual=residual,
-        rademacher=rademacher,
-    )
+    if divergence_fn == "colored" and not hasattr(diffeq, "coloring_probes"):
+        raise ValueError("The colored divergence needs the Jacobian sparsity of the net, {} has none, "
+                         "use a faithful flow_connectivity".format(type(diffeq).__name__))
+    if scripted:
+        assert divergence_fn == "approximate", "The scripted right hand side only estimates the divergence"
+        assert num_probes == 1 and probe != "orthogonal", "The scripted right hand side draws one probe"
+        # right hand side and divergence as one TorchScript call, see jit_nets.check_parity
+        from jit_nets import ScriptedODEfunc
+        odefunc = ScriptedODEfunc(diffeq, rademacher=probe == "rademacher")
+    else:
+        odefunc = layers.ODEfunc(
+            diffeq=diffeq,
+            divergence_fn=divergence_fn,
+            residual=residual,
+            rademacher=rademacher,
+            num_probes=num_probes,
+            probe=probe,
+        )
     cnf = layers.CNF(
         odefunc=odefunc,
         T=time_length,
         train_T=train_T,
         regularization_fns=regularization_fns,
-        solver=solver,
+        backprop_mode=backprop_mode,
+        memory_budget=memory_budget,
     )
 
-    set_cnf_options(cnf)
+    set_cnf_options(cnf, **(solver_settings or {}))
 
     return cnf
 
@@ -86,28 +125,55 @@ def get_transforms(model):
     return sample_fn, density_fn
 
 
-def compute_loss(args, log_scalar):
-    # load data
-    x, y = create_batch(args.gmodel.sample, args.batch_size)
+def log_joint(gmodel, x, y):
+    """Returns log prior and log likelihood, in one pass if the model supports it."""
+    if hasattr(gmodel, "log_joint"):
+        return gmodel.log_joint(x, y)
+    return gmodel.log_prior(x), gmodel.log_likelihood(x, y)
+
+
+def compute_loss(args, log_scalar, batch=None):
+    # load data, either prefetched by a simulation pipeline or drawn inline
+    if batch is None:
+        batch = create_batch(args.gmodel.sample, args.batch_size)
+    x, y = batch
+    assert x.shape[0] == args.batch_size
     x = x.to(args.device)
     y = y.to(args.device)
     x_ = (x - args.xshift)/args.xscale
     logp_xscale = -torch.sum(torch.log(args.xscale)) # change of variable
     y_ = (y - args.yshift)/args.yscale
-    args.diffeq.conditioned[:, :] = y_
+
+    # the reverse KL term uses K = repeat_samples flow samples per observation,
+    # rows of the same observation are consecutive, the forward term the
+    # batch_size pairs. Each solve is bound to its own conditioning, the
+    # adjoint pass of the reverse solve runs after the forward solve
+    K = args.repeat_samples
+    y_rep = y.repeat_interleave(K, dim=0)
+    y_rep_ = y_.repeat_interleave(K, dim=0)
 
     p_ = Normal(0.0, 1.0)  # rescale with marginal statistics
-    x0 = p_.sample(x.shape).to(x)
+    x0 = p_.sample([x.shape[0] * K, x.shape[1]]).to(x)
     P_ = p_.log_prob(x0).sum(dim=1) # P underscore
 
+    # both solves enter the loss, they have to backpropagate the same way
+    if args.cnf.training:
+        args.cnf.plan_backprop_mode((x0, y_rep_), (x_, y_))
+
     # reverse KL terms
     print("== reverse pass")
     args.direction = 1.0
 
     # transform to z
     z, delta_log_q = map(last, args.cnf(x0, P_.unsqueeze(1), 
-                                        integration_times=args.integration_times))
+                                        integration_times=args.integration_times, conditioned=y_rep_))
     reverse_num_evals = args.cnf.num_evals()
+    if hasattr(args.diffeq, "num_weight_builds"):
+        log_scalar("reverse_weight_builds", args.diffeq.num_weight_builds())
+    if args.cnf.divergence_variance() is not None:
+        log_scalar("reverse_divergence_variance", args.cnf.divergence_variance())
+    if args.cnf.backprop_mode == "auto":
+        log_scalar("reverse_direct_backprop", float(args.cnf.last_backprop_mode == "direct"))
 
     reverse_reg = args.cnf.get_regularization_states()
     if len(reverse_reg) == 2:
@@ -116,11 +182,11 @@ def compute_loss(args, log_scalar):
 
 
 
-    PI = args.gmodel.log_prior(z*args.xscale + args.xshift)
-    LAMBDA = args.gmodel.log_likelihood(z*args.xscale + args.xshift, y)
+    PI, LAMBDA = log_joint(args.gmodel, z*args.xscale + args.xshift, y_rep)
     Q = ((delta_log_q.squeeze(1)) + logp_xscale)
 
-    shifted_reverse_kl = Q - (PI + LAMBDA)
+    # [M*K] -> [M] average over the flow samples of each observation
+    shifted_reverse_kl = (Q - (PI + LAMBDA)).view(-1, K).mean(dim=1)
 
 
     # forward KL terms
@@ -128,8 +194,14 @@ def compute_loss(args, log_scalar):
     args.direction = -1.0
 
     zero = torch.zeros(x.shape[0], 1).to(x)
-    z_, delta_log_p_ = map(last, args.cnf(x_, zero, reverse=True))
+    z_, delta_log_p_ = map(last, args.cnf(x_, zero, reverse=True, conditioned=y_))
     forward_num_evals = args.cnf.num_evals()
+    if hasattr(args.diffeq, "num_weight_builds"):
+        log_scalar("forward_weight_builds", args.diffeq.num_weight_builds())
+    if args.cnf.divergence_variance() is not None:
+        log_scalar("forward_divergence_variance", args.cnf.divergence_variance())
+    if args.cnf.backprop_mode == "auto":
+        log_scalar("forward_direct_backprop", float(args.cnf.last_backprop_mode == "direct"))
 
     forward_reg = args.cnf.get_regularization_states()
     if len(forward_reg) == 2:
@@ -137,14 +209,15 @@ def compute_loss(args, log_scalar):
         log_scalar("forward_arc_len", forward_reg[1][1].item())
 
     P__ = p_.log_prob(z_).sum(dim=1)
-    PI_ = args.gmodel.log_prior(x)
-    LAMBDA_ = args.gmodel.log_likelihood(x, y)
+    PI_, LAMBDA_ = log_joint(args.gmodel, x, y)
     Q_ = P__ - delta_log_p_.squeeze(1) + logp_xscale
 
     assert PI_.shape == torch.Size([args.batch_size])
     assert LAMBDA_.shape == torch.Size([args.batch_size])
 
     shifted_forward_kl = (PI_ + LAMBDA_) - Q_
+    assert shifted_forward_kl.shape == torch.Size([args.batch_size])
+    assert shifted_reverse_kl.shape == torch.Size([args.batch_size])
 
 
     result = namedtuple("FlowResult",
@@ -162,7 +235,40 @@ def compute_loss(args, log_scalar):
     return result
 
 
+def training_loss(res, loss_choice):
+    """Returns the objective of loss_choice for a compute_loss result, the
+    regularized choices need regularization_fns in the CNF."""
+    if loss_choice == "forward":
+        return res.forward_kl
+    if loss_choice == "backward":
+        return res.reverse_kl
+    if loss_choice == "sym":
+        #rescale_reverse = forward_kl.item()/reverse_kl.item()
+        return res.forward_kl + res.reverse_kl
+    if loss_choice == "sym_reg":
+        # Only reverse KL makes sense for angles because logp is only known in this case
+        return res.forward_kl + res.reverse_kl + res.reverse_reg[0][1]
+    if loss_choice == "forw_reg":
+        # Only reverse KL makes sense for angles because logp is only known in this case
+        return res.forward_kl + res.reverse_reg[0][1]
+    if loss_choice == "reg_only":
+        reverse_angle = res.reverse_reg[0][1]
+        return reverse_angle
+    raise Exception("Loss choice unknown: {}".format(loss_choice))
+
+
 def create_batch(sample_fn, minibatch_size=10, repeat_samples=1):
+    # draw the whole minibatch with tensor ops if the model supports it
+    gmodel = getattr(sample_fn, "__self__", None)
+    if hasattr(gmodel, "sample_batch"):
+        xs, ys = gmodel.sample_batch(minibatch_size)
+        xs = xs.repeat_interleave(repeat_samples, dim=0)
+        ys = ys.repeat_interleave(repeat_samples, dim=0)
+
+        assert(xs.shape == (minibatch_size*repeat_samples, gmodel.dim_latent))
+        assert(ys.shape == (minibatch_size*repeat_samples, gmodel.dim_condition))
+        return xs, ys
+
     xs = []
     ys = []
     for _ in range(minibatch_size):
@@ -177,3 +283,58 @@ def create_batch(sample_fn, minibatch_size=10, repeat_samples=1):
     assert(ys.shape == (minibatch_size*repeat_samples, ys[0].shape[0]))
     return xs, ys
 
+
+class RunningStatistics:
+    """Columnwise mean and standard deviation, merged chunk by chunk (Welford/Chan)."""
+
+    def __init__(self, dim):
+        self.count = 0
+        self.mean = torch.zeros(dim, dtype=torch.float64)
+        self.m2 = torch.zeros(dim, dtype=torch.float64)
+
+    def update(self, xs):
+        xs = xs.to(torch.float64)
+        n = xs.shape[0]
+        mean = xs.mean(dim=0)
+        m2 = ((xs - mean)**2).sum(dim=0)
+        delta = mean - self.mean
+        total = self.count + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.count * n / total
+        self.count = total
+
+    def std(self):
+        return torch.sqrt(self.m2 / max(self.count - 1, 1))
+
+
+def streaming_statistics(sample_fn, num_samples=10000, chunk_size=1000, cache_path=None, seed=0):
+    """Returns (xmean, xstd, ymean, ystd) of num_samples simulated pairs without
+    materializing them at once. Results are cached in cache_path if given.
+
+    The pairs are drawn from torch and numpy generators forked and seeded
+    with seed, so the random stream of the caller is the same whether the
+    cache hits or not."""
+    if cache_path is not None and os.path.exists(cache_path):
+        return torch.load(cache_path)
+
+    xstats = None
+    np_state = np.random.get_state()
+    try:
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            for start in range(0, num_samples, chunk_size):
+                xs, ys = create_batch(sample_fn, min(chunk_size, num_samples - start))
+                if xstats is None:
+                    xstats = RunningStatistics(xs.shape[1])
+                    ystats = RunningStatistics(ys.shape[1])
+                xstats.update(xs)
+                ystats.update(ys)
+    finally:
+        np.random.set_state(np_state)
+
+    stats = tuple(s.float() for s in (xstats.mean, xstats.std(), ystats.mean, ystats.std()))
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        torch.save(stats, cache_path)
+    return stats
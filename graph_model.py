@@ -0,0 +1,281 @@
+import json
+import re
+from functools import reduce
+
+import torch
+from torch.distributions import Normal, Laplace, Bernoulli, Uniform, Beta, Gamma, Exponential
+
+from adjacency import Adjacency
+from density import FAMILIES, LogJoint, Node
+
+
+def _tensor(v):
+    return v if isinstance(v, torch.Tensor) else torch.tensor(v, dtype=torch.get_default_dtype())
+
+
+def _sub(*args):
+    if len(args) == 1:
+        return -args[0]
+    return reduce(lambda a, b: a - b, args)
+
+
+def _div(*args):
+    if len(args) == 1:
+        return 1.0 / args[0]
+    return reduce(lambda a, b: a / b, args)
+
+
+PRIMITIVES = {
+    "+": lambda *args: reduce(lambda a, b: a + b, args),
+    "-": _sub,
+    "*": lambda *args: reduce(lambda a, b: a * b, args),
+    "/": _div,
+    "exp": lambda a: torch.exp(_tensor(a)),
+    "log": lambda a: torch.log(_tensor(a)),
+    "sqrt": lambda a: torch.sqrt(_tensor(a)),
+    "tanh": lambda a: torch.tanh(_tensor(a)),
+    "sigmoid": lambda a: torch.sigmoid(_tensor(a)),
+    "abs": lambda a: torch.abs(_tensor(a)),
+    "pow": lambda a, b: torch.pow(_tensor(a), b),
+    "max": lambda *args: reduce(lambda a, b: torch.max(_tensor(a), _tensor(b)), args),
+    "min": lambda *args: reduce(lambda a, b: torch.min(_tensor(a), _tensor(b)), args),
+    "=": lambda a, b: _tensor(a) == _tensor(b),
+    "<": lambda a, b: _tensor(a) < _tensor(b),
+    ">": lambda a, b: _tensor(a) > _tensor(b),
+    "<=": lambda a, b: _tensor(a) <= _tensor(b),
+    ">=": lambda a, b: _tensor(a) >= _tensor(b),
+    "and": lambda *args: reduce(lambda a, b: _tensor(a).bool() & _tensor(b).bool(), args),
+    "or": lambda *args: reduce(lambda a, b: _tensor(a).bool() | _tensor(b).bool(), args),
+    "not": lambda a: ~_tensor(a).bool(),
+}
+
+# distribution constructors and the names of their positional parameters
+DISTRIBUTIONS = {
+    "normal": (Normal, ("loc", "scale")),
+    "laplace": (Laplace, ("loc", "scale")),
+    "flip": (Bernoulli, ("probs",)),
+    "bernoulli": (Bernoulli, ("probs",)),
+    "uniform": (Uniform, ("low", "high")),
+    "uniform-continuous": (Uniform, ("low", "high")),
+    "beta": (Beta, ("concentration1", "concentration0")),
+    "gamma": (Gamma, ("concentration", "rate")),
+    "exponential": (Exponential, ("rate",)),
+}
+DISTRIBUTION_PARAMS = {dist: params for dist, params in DISTRIBUTIONS.values()}
+
+
+def _where(cond, a, b):
+    """Batched if: selects values, or parameters of same-family distributions."""
+    if isinstance(cond, bool) or (isinstance(cond, torch.Tensor) and cond.dim() == 0):
+        return a if bool(cond) else b
+    if isinstance(a, torch.distributions.Distribution):
+        if type(a) != type(b):
+            raise ValueError("Cannot batch if over {} and {}.".format(type(a).__name__, type(b).__name__))
+        return type(a)(*[torch.where(cond, getattr(a, k), getattr(b, k))
+                         for k in DISTRIBUTION_PARAMS[type(a)]])
+    return torch.where(cond, _tensor(a), _tensor(b))
+
+
+def compile_expression(exp):
+    """Compiles a link expression of the graph JSON into a closure env -> value.
+
+    Symbols refer to columns of the batch in env, numbers and booleans are
+    constants and lists are applications of primitives or distributions.
+    """
+    if isinstance(exp, (bool, int, float)) or exp is None:
+        return lambda env: exp
+    if isinstance(exp, str):
+        return lambda env: env[exp]
+    if not isinstance(exp, list) or len(exp) == 0:
+        raise ValueError("Cannot compile expression: {}".format(exp))
+
+    op, args = exp[0], [compile_expression(a) for a in exp[1:]]
+    if op == "if":
+        cond, then_, else_ = args
+        return lambda env: _where(cond(env), then_(env), else_(env))
+    if op in ("sample*", "observe*"):
+        # the observed value is kept in Y, only the distribution matters here
+        return args[0]
+    if op in DISTRIBUTIONS:
+        dist = DISTRIBUTIONS[op][0]
+        return lambda env: dist(*[a(env) for a in args])
+    if op in PRIMITIVES:
+        f = PRIMITIVES[op]
+        return lambda env: f(*[a(env) for a in args])
+    raise ValueError("Unsupported primitive: {}".format(op))
+
+
+def _symbols(exp):
+    if isinstance(exp, str):
+        return {exp}
+    if isinstance(exp, list):
+        return set().union(*[_symbols(e) for e in exp])
+    return set()
+
+
+def _random(exp):
+    return isinstance(exp, list) and len(exp) > 0 and \
+        (exp[0] in ("sample*", "observe*") or any(_random(e) for e in exp[1:]))
+
+
+def _split_conditional(exp):
+    """Splits the conditional observe ["if", phi, ["observe*", d, y], 1] the
+    graph compiler emits for observes in if branches into phi and the
+    observe. phi is None for unconditional vertices."""
+    if isinstance(exp, list) and len(exp) > 0 and exp[0] == "if":
+        if len(exp) == 4 and isinstance(exp[2], list) and len(exp[2]) > 0 and exp[2][0] == "observe*" \
+                and not _random(exp[1]) and not _random(exp[3]):
+            return exp[1], exp[2]
+        raise ValueError("Unsupported conditional vertex: {}".format(exp))
+    return None, exp
+
+
+def _index(name):
+    return int(re.search(r"\d+$", name).group(0))
+
+
+def topological_sort(V, A):
+    """Kahn's algorithm over the vertices V with forward adjacency A."""
+    parents = {v: set() for v in V}
+    for p, children in A.items():
+        for c in children:
+            parents[c].add(p)
+    order = []
+    ready = sorted([v for v in V if not parents[v]], key=_index)
+    while ready:
+        v = ready.pop(0)
+        order.append(v)
+        for c in sorted(A.get(v, []), key=_index):
+            parents[c].discard(v)
+            if not parents[c] and c not in order and c not in ready:
+                ready.append(c)
+        ready.sort(key=_index)
+    if len(order) != len(V):
+        raise ValueError("Graph contains a cycle.")
+    return order
+
+
+class GraphModel:
+    """Vectorized graphical model compiled from the output of `daphne graph`.
+
+    Latents are the sample vertices sorted by their gensym index, the
+    conditioning variables are the observe vertices in the same order, like
+    in the python-class export. adjacency holds the forward edges as
+    [parent, child] pairs in the joint index space where observes follow
+    the dim_latent latents. faithful_adjacency is derived from it by
+    Adjacency.faithful_inverse, rand_adjacency has as many random edges.
+    Observes in if branches, which the compiler emits as
+    ["if", phi, ["observe*", d, y], 1], only enter the log likelihood where
+    phi holds, and the latents of phi become their parents.
+    """
+
+    def __init__(self, graph):
+        if isinstance(graph, list):
+            # full [rho, G, E] output of the graph command
+            graph = graph[1]
+        V, A, P, Y = graph["V"], graph.get("A", {}), graph["P"], graph.get("Y", {})
+
+        self.latents = sorted([v for v in V if v not in Y], key=_index)
+        self.observes = sorted([v for v in V if v in Y], key=_index)
+        self.dim_latent = len(self.latents)
+        self.dim_condition = len(self.observes)
+        for o in self.observes:
+            if isinstance(Y[o], (list, dict)):
+                raise ValueError("Observation {} is not a scalar, GraphModel has one column "
+                                 "per vertex: {}".format(o, Y[o]))
+        self.observed = torch.tensor([float(Y[o]) for o in self.observes])
+
+        # observes in if branches only count where their condition holds
+        self.conditions, links = {}, {}
+        A = {p: list(cs) for p, cs in A.items()}
+        for v in V:
+            phi, links[v] = _split_conditional(P[v])
+            if phi is not None:
+                self.conditions[v] = compile_expression(phi)
+                # the condition decides over the likelihood like a parent
+                for p in sorted(_symbols(phi) & set(V), key=_index):
+                    if v not in A.setdefault(p, []):
+                        A[p].append(v)
+
+        columns = {v: i for i, v in enumerate(self.latents + self.observes)}
+        self.adjacency = Adjacency.from_pairs([[columns[p], columns[c]] for p, cs in A.items() for c in cs],
+                                              (len(columns), len(columns)))
+        self.faithful_adjacency = self.adjacency.faithful_inverse(self.dim_latent)
+        self.rand_adjacency = Adjacency.random(self.faithful_adjacency.shape,
+                                               len(self.faithful_adjacency))
+
+        self.order = topological_sort(V, A)
+        self.links = {v: compile_expression(links[v]) for v in V}
+        self.density = self._compile_density(P, columns)
+
+    def _compile_param(self, exp):
+        if isinstance(exp, (int, float)) and not isinstance(exp, bool):
+            return float(exp)
+        if exp in self.latents:
+            return [self.latents.index(exp)]
+        f = compile_expression(exp)
+        return lambda x: _tensor(f(self._env(x))).to(x).expand(x.shape[0])
+
+    def _compile_density(self, P, columns):
+        """Fused log joint, if all vertices are unconditional normal or
+        laplace with parameters depending on latents only. Returns None
+        otherwise."""
+        nodes = []
+        for v in self.latents + self.observes:
+            exp = P[v]
+            if isinstance(exp, list) and exp and exp[0] in ("sample*", "observe*"):
+                exp = exp[1]
+            if not (isinstance(exp, list) and exp and exp[0] in FAMILIES):
+                return None
+            if _symbols(exp[1:]) & set(self.observes):
+                return None
+            nodes.append(Node(columns[v], exp[0], *[self._compile_param(a) for a in exp[1:]]))
+        return LogJoint(nodes, self.dim_latent)
+
+    def _env(self, x, y=None):
+        env = {v: x[:, i] for i, v in enumerate(self.latents)}
+        if y is not None:
+            env.update({v: y[:, i] for i, v in enumerate(self.observes)})
+        return env
+
+    def sample_batch(self, n):
+        env = {}
+        for v in self.order:
+            dist = self.links[v](env)
+            if dist.batch_shape != torch.Size([n]):
+                dist = dist.expand([n])
+            env[v] = dist.sample().to(torch.get_default_dtype())
+        xs = torch.stack([env[v] for v in self.latents], dim=1)
+        ys = torch.stack([env[v] for v in self.observes], dim=1) if self.observes \
+            else torch.zeros([n, 0])
+        return xs, ys
+
+    def sample(self):
+        xs, ys = self.sample_batch(1)
+        return xs[0], ys[0]
+
+    def _log_prob(self, env, vertices, values):
+        acc = values.new_zeros(values.shape[0])
+        for i, v in enumerate(vertices):
+            log_prob = self.links[v](env).log_prob(values[:, i])
+            if v in self.conditions:
+                log_prob = torch.where(_tensor(self.conditions[v](env)).bool().to(values.device),
+                                       log_prob, torch.zeros_like(log_prob))
+            acc = acc + log_prob
+        return acc
+
+    def log_prior(self, x):
+        return self._log_prob(self._env(x), self.latents, x)
+
+    def log_likelihood(self, x, y):
+        return self._log_prob(self._env(x, y), self.observes, y)
+
+    def log_joint(self, x, y):
+        if self.density is None:
+            return self.log_prior(x), self.log_likelihood(x, y)
+        return self.density(x, y)
+
+
+def load_graph(path):
+    with open(path) as f:
+        return GraphModel(json.load(f))
@@ -0,0 +1,118 @@
+import os
+
+import torch
+import torch.nn as nn
+
+from flow import log_joint
+
+
+class _Traced(nn.Module):
+    # wraps a model method, torch.jit.trace needs a module to be saveable
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+
+    def forward(self, *inputs):
+        return self.fn(*(inputs + self.args))
+
+
+class ScriptedModel:
+    """Graphical model with TorchScript versions of its densities and sampler.
+
+    log_prior, log_likelihood and log_joint are traced on an example batch
+    and accept any batch size afterwards. sample_batch is traced for the
+    fixed batch size n (the training minibatch size), other sizes fall back
+    to the eager model. Samplers which leave torch, e.g. ToyData through
+    numpy, would be traced into constants and are not supported, use
+    check_parity to verify a model. All other attributes are forwarded to
+    the wrapped model.
+    """
+
+    def __init__(self, gmodel, n, device=torch.device("cpu")):
+        self.gmodel = gmodel
+        self.n = n
+        x, y = gmodel.sample_batch(n)
+        x, y = x.to(device), y.to(device)
+
+        trace = lambda fn, *inputs: torch.jit.trace(_Traced(fn), inputs, check_trace=False)
+        self.traced_log_prior = trace(gmodel.log_prior, x)
+        self.traced_log_likelihood = trace(gmodel.log_likelihood, x, y)
+        self.traced_log_joint = trace(lambda x, y: log_joint(gmodel, x, y), x, y)
+        self.traced_sample_batch = torch.jit.trace(_Traced(gmodel.sample_batch, n), (),
+                                                   check_trace=False)
+
+    def __getattr__(self, name):
+        if name == "gmodel":
+            raise AttributeError(name)
+        return getattr(self.gmodel, name)
+
+    def log_prior(self, x):
+        return self.traced_log_prior(x)
+
+    def log_likelihood(self, x, y):
+        return self.traced_log_likelihood(x, y)
+
+    def log_joint(self, x, y):
+        return self.traced_log_joint(x, y)
+
+    def sample_batch(self, n):
+        if n != self.n:
+            return self.gmodel.sample_batch(n)
+        return self.traced_sample_batch()
+
+    def sample(self):
+        return self.gmodel.sample()
+
+    def save(self, path):
+        """Writes the traced functions as TorchScript archives, loadable with torch.jit.load."""
+        os.makedirs(path, exist_ok=True)
+        for name in ("log_prior", "log_likelihood", "log_joint", "sample_batch"):
+            torch.jit.save(getattr(self, "traced_" + name), os.path.join(path, name + ".pt"))
+
+
+def check_parity(gmodel, n=64, tol=1e-4, seed=0):
+    """Compares a ScriptedModel against the eager model it wraps.
+
+    Densities and their gradients are compared on a batch of a different
+    size than the traced one, samplers by replaying the same seed. Returns
+    the maximum deviations |eager - traced| / (1 + |eager|) and raises if
+    one exceeds tol.
+    """
+    scripted = ScriptedModel(gmodel, n)
+    x, y = gmodel.sample_batch(2 * n)
+
+    deviations = {}
+
+    def compare(name, eager, traced):
+        deviations[name] = max([((a - b).abs() / (1 + a.abs())).max().item() if a.numel() > 0 else 0.0
+                                for a, b in zip(eager, traced)])
+
+    compare("log_prior", [gmodel.log_prior(x)], [scripted.log_prior(x)])
+    compare("log_likelihood", [gmodel.log_likelihood(x, y)], [scripted.log_likelihood(x, y)])
+    compare("log_joint", log_joint(gmodel, x, y), scripted.log_joint(x, y))
+
+    grads = []
+    for f in (lambda x: log_joint(gmodel, x, y), lambda x: scripted.log_joint(x, y)):
+        x_ = x.clone().requires_grad_(True)
+        grads.append(torch.autograd.grad(sum(f(x_)).sum(), x_)[0])
+    compare("grad_log_joint", [grads[0]], [grads[1]])
+
+    torch.manual_seed(seed)
+    eager = gmodel.sample_batch(n)
+    torch.manual_seed(seed)
+    traced = scripted.sample_batch(n)
+    compare("sample_batch", eager, traced)
+
+    for name, deviation in deviations.items():
+        if not deviation <= tol:
+            raise AssertionError("{} deviates by {} from the eager model".format(name, deviation))
+    return deviations
+
+
+if __name__ == "__main__":
+    from registry import MODELS, create_model
+    for name in sorted(MODELS):
+        if name in ("8gaussians", "rings", "swissroll"):
+            continue  # numpy samplers
+        print(name, check_parity(create_model(name)))
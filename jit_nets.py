@@ -0,0 +1,142 @@
+from typing import List, Optional, Tuple
+
+import torch
+
+from flow import create_batch
+from lib.layers.odefunc import ODEfunc, sample_gaussian_like, sample_rademacher_like
+from nets import AdaptedODENet, SparseODENet, _dense_weight
+
+
+@torch.jit.script
+def concat_squash_rhs(t: torch.Tensor, x: torch.Tensor, e: torch.Tensor,
+                      weights: List[torch.Tensor], biases: List[torch.Tensor], t_weight: torch.Tensor,
+                      gate_weights: List[torch.Tensor], gate_biases: List[torch.Tensor],
+                      bias_weights: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Right hand side of AdaptedODENet/SparseODENet and its Hutchinson divergence e^T (df/dx) e.
+
+    weights are the transposed dense weights, the first one only for the x
+    block of the input, biases[0] is the [batch, dim] projection of the
+    conditioning plus the bias and t_weight the t column of the first layer.
+    """
+    dx = x
+    num_layers = len(weights)
+    for l in range(num_layers):
+        h = torch.addmm(biases[l], dx, weights[l])
+        if l == 0:
+            h = h + t * t_weight
+        h = h * torch.sigmoid(t * gate_weights[l] + gate_biases[l]) + t * bias_weights[l]
+        if l < num_layers - 1:
+            h = torch.tanh(h)
+            dx = h if l == 0 else dx + h
+        else:
+            dx = h
+    grad_outputs: List[Optional[torch.Tensor]] = [e]
+    e_dzdx = torch.autograd.grad([dx], [x], grad_outputs, create_graph=True)[0]
+    assert e_dzdx is not None
+    return dx, (e_dzdx * e).sum(dim=1, keepdim=True)
+
+
+class ScriptedODEfunc(ODEfunc):
+    """ODEfunc evaluating AdaptedODENet or SparseODENet with concat_squash_rhs.
+
+    The whole right hand side including the approximate divergence is one
+    TorchScript call, the Python side only hands over the parameters. These
+    are collected once per solve as dense matrices, so masked and
+    gather-scatter layers become plain matmuls, which suits the small nets where interpreter overhead
+    dominates. Parameters stay owned by diffeq, checkpoints are
+    interchangeable with the eager ODEfunc, and trajectories are recorded
+    like in the nets while diffeq.is_recording is set. Use check_parity to
+    compare both paths.
+    """
+
+    def __init__(self, diffeq, rademacher=False):
+        assert isinstance(diffeq, (AdaptedODENet, SparseODENet)), \
+            "Only AdaptedODENet and SparseODENet can be scripted, not {}".format(type(diffeq).__name__)
+        super(ScriptedODEfunc, self).__init__(diffeq, divergence_fn="approximate", rademacher=rademacher)
+        self._params = None
+
+    def clear_caches(self):
+        super(ScriptedODEfunc, self).clear_caches()
+        self._params = None
+
+    def _collect(self, n):
+        y = self.diffeq.conditioned
+        weights, biases = zip(*[_dense_weight(layer) for layer in self.diffeq.layers])
+        m = y.shape[1]
+        first = weights[0]
+        weights = [first[:n]] + list(weights[1:])
+        biases = [torch.addmm(biases[0], y, first[n:n + m])] + list(biases[1:])
+        layers = self.diffeq.layers
+        return (weights, biases, first[n + m:],
+                [l._hyper_gate.weight.view(-1) for l in layers], [l._hyper_gate.bias for l in layers],
+                [l._hyper_bias.weight.view(-1) for l in layers])
+
+    def forward(self, t, states):
+        assert len(states) >= 2
+        y = states[0]
+        self._num_evals += 1
+
+        t = torch.as_tensor(t).detach().type_as(y)
+        if self._e is None:
+            self._e = sample_rademacher_like(y) if self.rademacher else sample_gaussian_like(y)
+
+        with torch.set_grad_enabled(True):
+            y.requires_grad_(True)
+            t.requires_grad_(True)
+            # forward always runs with grad enabled, also in the adjoint
+            # passes, so the parameters of a solve are collected once
+            if self._params is None:
+                self._params = self._collect(y.shape[1])
+            # the profiling executor's differentiable subgraphs cost more than
+            # they save on nets this small, the plain interpreter is faster
+            with torch.jit.optimized_execution(False):
+                dy, divergence = concat_squash_rhs(t, y, self._e, *self._params)
+            if self.diffeq.is_recording:
+                self.diffeq.recorder.record(t, dy, y)
+        return tuple([dy, -divergence] + [torch.zeros_like(s_).requires_grad_(True) for s_ in states[2:]])
+
+
+def check_parity(diffeq, batch_size=16, tol=1e-4, seed=0):
+    """Compares ScriptedODEfunc against the eager ODEfunc on the same net.
+
+    Outputs and parameter gradients of a few evaluations at different times
+    are compared with the same noise. Returns the maximum deviations
+    |eager - scripted| / (1 + |eager|) and raises if one exceeds tol.
+    """
+    torch.manual_seed(seed)
+    dim = diffeq.layers[-1]._hyper_gate.out_features
+    y = torch.randn(batch_size, dim)
+    e = torch.randn(batch_size, dim)
+    logp = torch.zeros(batch_size, 1)
+    params = list(diffeq.parameters())
+
+    deviations = {}
+    funcs = {"eager": ODEfunc(diffeq), "scripted": ScriptedODEfunc(diffeq)}
+    for t in (0.0, 0.3, 1.0):
+        results = {}
+        for name, func in funcs.items():
+            func.before_odeint(e)
+            dy, dlogp = func(torch.tensor(t), (y.clone(), logp))
+            grads = torch.autograd.grad(dy.pow(2).sum() + dlogp.sum(), params, allow_unused=True)
+            results[name] = [dy, dlogp] + [g if g is not None else torch.zeros_like(p) for g, p in zip(grads, params)]
+        deviations["t={}".format(t)] = max(((a - b).abs() / (1 + a.abs())).max().item()
+                                           for a, b in zip(results["eager"], results["scripted"]))
+
+    for name, deviation in deviations.items():
+        if not deviation <= tol:
+            raise AssertionError("{} deviates by {} from the eager ODEfunc".format(name, deviation))
+    return deviations
+
+
+if __name__ == "__main__":
+    from registry import create_model
+    for name in ("bigger_graph1", "state_space", "synthetic-random-100-fan_in=2"):
+        gmodel = create_model(name)
+        nets = {"fully_connected": AdaptedODENet(gmodel.dim_latent, gmodel.dim_condition)}
+        for mode in ("dense", "sparse"):
+            nets["faithful_" + mode] = SparseODENet(gmodel.dim_latent, gmodel.dim_condition,
+                                                     gmodel.faithful_adjacency, torch.device("cpu"),
+                                                     sparse_mode=mode)
+        for net_name, diffeq in nets.items():
+            diffeq.conditioned = create_batch(gmodel.sample, 16)[1]
+            print(name, net_name, check_parity(diffeq))
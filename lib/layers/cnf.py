@@ -1,7 +1,14 @@
+import functools
+import inspect
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
-from torchdiffeq import odeint_adjoint as odeint
+from torchdiffeq import odeint, odeint_adjoint
+from torchdiffeq._impl.dopri5 import Dopri5Solver
+from torchdiffeq._impl.misc import _check_inputs
+from torchdiffeq._impl.rk_common import _RungeKuttaState
 
 from .wrappers.cnf_regularization import RegularizedODEfunc
 
@@ -10,8 +17,11 @@ __all__ = ["CNF"]
 
 class CNF(nn.Module):
     def __init__(self, odefunc, T=1.0, train_T=False, regularization_fns=None,
-                 solver='dopri5', atol=1e-5, rtol=1e-5):
+                 solver='dopri5', atol=1e-5, rtol=1e-5, backprop_mode="adjoint", memory_budget=None):
         super(CNF, self).__init__()
+        assert backprop_mode in ("adjoint", "direct", "auto", "checkpoint")
+        assert backprop_mode != "auto" or memory_budget is not None, "auto backprop needs a memory budget"
+        check_backprop_solver(backprop_mode, solver)
         if train_T:
             self.register_parameter("sqrt_end_time", nn.Parameter(torch.sqrt(torch.tensor(T))))
         else:
@@ -31,8 +41,25 @@ class CNF(nn.Module):
         self.test_atol = atol
         self.test_rtol = rtol
         self.solver_options = {}
+        self.test_solver_options = {}
+
+        # training solves backpropagate through the solver ("direct"), which
+        # keeps the graph of every evaluation, or solve the adjoint ODE
+        # backwards ("adjoint"), "auto" picks direct when the estimated graphs
+        # of the solves of a loss fit into memory_budget bytes, see
+        # plan_backprop_mode. "checkpoint" keeps only
+        # the solver states of the steps and recomputes one step at a time
+        # in the backward pass, see odeint_checkpointed
+        self.backprop_mode = backprop_mode
+        self.memory_budget = memory_budget
+        self.last_backprop_mode = None
+        self._eval_bytes = {}
+        self._expected_nfe = None
+        self._planned_backprop_mode = None
 
-    def forward(self, z, logpz=None, integration_times=None, reverse=False):
+    def forward(self, z, logpz=None, integration_times=None, reverse=False, conditioned=None):
+        """conditioned, if given, is the conditioning of the diffeq for this
+        solve, including the evaluations of its adjoint pass."""
 
         if logpz is None:
             _logpz = torch.zeros(z.shape[0], 1).to(z)
@@ -49,11 +76,18 @@ class CNF(nn.Module):
 
         # Add regularization states.
         reg_states = tuple(torch.tensor(0).to(z) for _ in range(self.nreg))
+        odefunc = self._bind(conditioned)
 
 
         if self.training:
-            state_t = odeint(
-                self.odefunc,
+            self.last_backprop_mode = self._planned_backprop_mode or self._select_backprop_mode((z, conditioned))
+            if self.last_backprop_mode == "checkpoint":
+                solve = functools.partial(odeint_checkpointed, clear_caches=getattr(
+                    self.odefunc, "clear_caches", lambda: None))
+            else:
+                solve = odeint_direct if self.last_backprop_mode == "direct" else odeint_adjoint
+            state_t = solve(
+                odefunc,
                 (z, _logpz) + reg_states,
                 integration_times.to(z),
                 atol=[self.atol, self.atol] + [1e20] * len(reg_states) if self.solver == 'dopri5' else self.atol,
@@ -61,14 +95,17 @@ class CNF(nn.Module):
                 method=self.solver,
                 options=self.solver_options,
             )
+            nfe = self.odefunc._num_evals.item()
+            self._expected_nfe = nfe if self._expected_nfe is None else max(nfe, 0.9 * self._expected_nfe)
         else:
-            state_t = odeint(
-                self.odefunc,
+            state_t = odeint_adjoint(
+                odefunc,
                 (z, _logpz),
                 integration_times.to(z),
                 atol=self.test_atol,
                 rtol=self.test_rtol,
                 method=self.test_solver,
+                options=self.test_solver_options,
             )
 
         #if len(integration_times) == 2:
@@ -82,6 +119,67 @@ class CNF(nn.Module):
         else:
             return z_t
 
+    def _bind(self, conditioned):
+        if conditioned is None:
+            return self.odefunc
+        odefunc = getattr(self.odefunc, "odefunc", self.odefunc)
+        return _ConditionedODEfunc(self.odefunc, odefunc.diffeq, conditioned)
+
+    def plan_backprop_mode(self, *solves):
+        """Fixes the backprop mode of the training solves until the next call
+        and returns it.
+
+        All solves of a loss have to backpropagate the same way: the adjoint
+        pass of one solve evaluates the diffeq with the caches the last solve
+        left behind, whose graph the backward pass of a direct solve frees.
+        solves are the (z, conditioned) pairs of the solves, with "auto"
+        direct is planned if all their graphs fit into memory_budget together."""
+        self._planned_backprop_mode = self._select_backprop_mode(*solves)
+        return self._planned_backprop_mode
+
+    def _select_backprop_mode(self, *solves):
+        if self.backprop_mode != "auto":
+            return self.backprop_mode
+        if not torch.is_grad_enabled():
+            return "direct"
+        if self._expected_nfe is None:
+            # no solve yet to estimate the number of evaluations from
+            return "adjoint"
+        graph_bytes = 0
+        for z, conditioned in solves:
+            key = (tuple(z.shape), self.nreg)
+            if key not in self._eval_bytes:
+                self._eval_bytes[key] = self.activation_bytes(z, conditioned=conditioned)
+            graph_bytes += self._expected_nfe * self._eval_bytes[key]
+        return "direct" if graph_bytes <= self.memory_budget else "adjoint"
+
+    def activation_bytes(self, z, logpz=None, reg_states=None, t=0.0, conditioned=None):
+        """Bytes of the tensors one evaluation of odefunc saves for backward.
+
+        Cached weights shared by all evaluations of a solve are counted
+        every time, so evaluations times this bounds the graph of a direct
+        solve from above. Infinite if torch cannot hook saved tensors (< 1.10).
+        """
+        graph = getattr(torch.autograd, "graph", None)
+        if not hasattr(graph, "saved_tensors_hooks"):
+            return float("inf")
+        if logpz is None:
+            logpz = torch.zeros(z.shape[0], 1).to(z)
+        if reg_states is None:
+            reg_states = tuple(torch.tensor(0).to(z) for _ in range(self.nreg))
+        odefunc = self._bind(conditioned)
+        saved = []
+
+        def pack(tensor):
+            saved.append(tensor.numel() * tensor.element_size())
+            return tensor
+
+        self.odefunc.before_odeint()
+        with graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            odefunc(torch.as_tensor(t).to(z), tuple(s.detach().clone() for s in (z, logpz) + reg_states))
+        self.odefunc.before_odeint()
+        return sum(saved)
+
     def get_regularization_states(self):
         reg_states = self.regularization_states
         self.regularization_states = None
@@ -90,6 +188,124 @@ class CNF(nn.Module):
     def num_evals(self):
         return self.odefunc._num_evals.item()
 
+    def divergence_variance(self):
+        odefunc = getattr(self.odefunc, "odefunc", self.odefunc)
+        return odefunc.divergence_variance()
+
+
+class _ConditionedODEfunc(nn.Module):
+    """odefunc bound to the conditioning and the probes of one solve.
+
+    The nets read their conditioning from diffeq.conditioned and the
+    odefunc keeps the probes of the divergence, both are replaced by the
+    next solve while the adjoint pass of this one still has to evaluate
+    with its own. Every evaluation puts them back, and clears the caches of
+    the odefunc that were built with another conditioning."""
+
+    def __init__(self, odefunc, diffeq, conditioned):
+        super(_ConditionedODEfunc, self).__init__()
+        self.odefunc = odefunc
+        # not a submodule, the parameters belong to odefunc
+        self.__dict__["diffeq"] = diffeq
+        self.conditioned = conditioned
+        self._e = None
+
+    def forward(self, t, states):
+        inner = getattr(self.odefunc, "odefunc", self.odefunc)
+        if getattr(self.diffeq, "conditioned", None) is not self.conditioned:
+            self.diffeq.conditioned = self.conditioned
+            self.odefunc.clear_caches()
+            inner._e = self._e
+        dstates = self.odefunc(t, states)
+        self._e = inner._e
+        return dstates
+
+
+class _DetachedStepDopri5(Dopri5Solver):
+    """dopri5 whose step sizes carry no gradient.
+
+    torchdiffeq computes the step sizes from the error estimates with
+    autograd, so backpropagating through the solver would also
+    differentiate the step size control, which gives wrong gradients."""
+
+    def before_integrate(self, t):
+        super(_DetachedStepDopri5, self).before_integrate(t)
+        self.rk_state = self.rk_state._replace(dt=self.rk_state.dt.detach())
+
+    def _adaptive_dopri5_step(self, rk_state):
+        rk_state = super(_DetachedStepDopri5, self)._adaptive_dopri5_step(rk_state)
+        return rk_state._replace(dt=rk_state.dt.detach())
+
+
+def odeint_direct(func, y0, t, rtol=1e-7, atol=1e-9, method=None, options=None):
+    """odeint for backpropagation through the solver steps, the fixed grid
+    solvers are differentiable as they are, dopri5 needs fixed step sizes."""
+    if method != "dopri5":
+        return odeint(func, y0, t, rtol=rtol, atol=atol, method=method, options=options)
+    tensor_input, func, y0, t = _check_inputs(func, y0, t)
+    solution = _DetachedStepDopri5(func, y0, rtol=rtol, atol=atol, **(options or {})).integrate(t)
+    return solution[0] if tensor_input else solution
+
+
+class _CheckpointedDopri5(_DetachedStepDopri5):
+    """dopri5 that keeps only the solver state of every step for backward.
+
+    Each step runs under a checkpoint, its graph is rebuilt from the stored
+    state when the backward pass reaches it. The gradients are those of the
+    forward trajectory, as with direct backprop, for the memory of the
+    steps' states and one step's graph. The checkpoints are reentrant, the
+    divergence differentiates inside the step, which makes non-reentrant
+    ones recompute the step during the forward pass, so parameter gradients
+    need backward() rather than torch.autograd.grad. clear_caches is called
+    at the start of every step, the cached values of the diffeq are shared
+    by all evaluations of a solve and the backward pass of the first
+    recomputed step would free their graph."""
+
+    def __init__(self, func, y0, rtol, atol, clear_caches=None, **kwargs):
+        super(_CheckpointedDopri5, self).__init__(func, y0, rtol, atol, **kwargs)
+        self.clear_caches = clear_caches
+
+    def _step(self, *tensors):
+        # the flattened rk state, see _adaptive_dopri5_step
+        n = len(self.y0)
+        rk_state = _RungeKuttaState(tensors[:n], tensors[n:2 * n], *tensors[2 * n:2 * n + 3],
+                                    interp_coeff=[tensors[i:i + n] for i in range(2 * n + 3, len(tensors), n)])
+        if self.clear_caches is not None:
+            self.clear_caches()
+        rk_state = super(_CheckpointedDopri5, self)._adaptive_dopri5_step(rk_state)
+        return _flatten_rk_state(rk_state)
+
+    def _adaptive_dopri5_step(self, rk_state):
+        n = len(self.y0)
+        tensors = checkpoint(self._step, *_flatten_rk_state(rk_state), **_REENTRANT)
+        return _RungeKuttaState(tensors[:n], tensors[n:2 * n], *tensors[2 * n:2 * n + 3],
+                                interp_coeff=[tensors[i:i + n] for i in range(2 * n + 3, len(tensors), n)])
+
+
+# torch >= 1.11 warns unless the checkpoint kind is explicit
+_REENTRANT = {"use_reentrant": True} if "use_reentrant" in inspect.signature(checkpoint).parameters else {}
+
+
+def _flatten_rk_state(rk_state):
+    y1, f1, t0, t1, dt, interp_coeff = rk_state
+    return tuple(y1) + tuple(f1) + (t0, t1, dt) + tuple(c for coeff in interp_coeff for c in coeff)
+
+
+def check_backprop_solver(backprop_mode, solver):
+    """Raises before training if the training solver cannot backpropagate in backprop_mode."""
+    if backprop_mode == "checkpoint" and solver != "dopri5":
+        raise ValueError("Checkpointed backprop supports dopri5, not {}".format(solver))
+
+
+def odeint_checkpointed(func, y0, t, rtol=1e-7, atol=1e-9, method=None, options=None, clear_caches=None):
+    """odeint with the steps checkpointed, only dopri5 is supported."""
+    if method != "dopri5":
+        raise ValueError("Checkpointed backprop supports dopri5, not {}".format(method))
+    tensor_input, func, y0, t = _check_inputs(func, y0, t)
+    solution = _CheckpointedDopri5(func, y0, rtol=rtol, atol=atol, clear_caches=clear_caches,
+                                   **(options or {})).integrate(t)
+    return solution[0] if tensor_input else solution
+
 
 def _flip(x, dim):
     indices = [slice(None)] * x.dim()
@@ -1,3 +1,4 @@
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -73,6 +74,70 @@ class SquashLinear(nn.Module):
         return self._layer(x) * torch.sigmoid(self._hyper(t.view(1, 1)))
 
 
+class TimeConditioning(object):
+    """Evaluates the time gates and biases of several ConcatSquash layers at once.
+
+    The _hyper_gate and _hyper_bias weights of all layers are concatenated
+    once per parameter update, so that every evaluation computes
+    sigmoid(w_g t + b_g) and w_b t for the whole net with one fused
+    multiply-add. The result is kept for the last time tensor, by identity
+    and version like the per-solve caches of the nets, so the layers of
+    one evaluation share it. The odefunc passes a new time tensor to every
+    evaluation, which always recomputes, so the gradient with respect to t
+    reaches every time tensor.
+
+    The layers keep their own parameters, so state dicts are unchanged, and
+    fall back to evaluating their hyper layers themselves when they are not
+    registered. Nets call clear in before_odeint.
+    """
+
+    def __init__(self, layers):
+        self.layers = [l for l in layers if hasattr(l, "_hyper_gate") and hasattr(l, "_hyper_bias")]
+        self.sizes = [l._hyper_gate.out_features for l in self.layers]
+        self.evaluations = 0
+        for i, layer in enumerate(self.layers):
+            layer._time_conditioning = (self, i)
+        self.clear()
+
+    def clear(self):
+        self._key = None
+        self._last = None
+
+    def _fused(self):
+        params = [l._hyper_gate.weight for l in self.layers] + [l._hyper_bias.weight for l in self.layers] \
+            + [l._hyper_gate.bias for l in self.layers]
+        key = tuple(p._version for p in params) + (params[0].device, params[0].dtype, torch.is_grad_enabled())
+        if key != self._key:
+            n = sum(self.sizes)
+            self._weight = torch.cat([p.view(-1) for p in params[:2 * len(self.layers)]])
+            self._bias = torch.cat(params[2 * len(self.layers):] + [torch.zeros_like(self._weight[n:])])
+            self._key = key
+            self._last = None
+        return self._weight, self._bias
+
+    def _evaluate(self, t):
+        weight, bias = self._fused()
+        if self._last is None or self._last[0] is not t or self._last[1] != t._version:
+            n = sum(self.sizes)
+            out = torch.addcmul(bias, t.view(1), weight)
+            gates = torch.sigmoid(out[:n]).split(self.sizes)
+            biases = out[n:].split(self.sizes)
+            self._last = (t, t._version, [(g.view(1, -1), b.view(1, -1)) for g, b in zip(gates, biases)])
+            self.evaluations += 1
+        return self._last[2]
+
+    def __call__(self, t, index):
+        return self._evaluate(t)[index]
+
+
+def hyper_gate_bias(layer, t):
+    """Returns sigmoid(_hyper_gate(t)) and _hyper_bias(t) of a ConcatSquash layer as [1, dim_out]."""
+    shared = getattr(layer, "_time_conditioning", None)
+    if shared is not None:
+        return shared[0](t, shared[1])
+    return torch.sigmoid(layer._hyper_gate(t.view(1, 1))), layer._hyper_bias(t.view(1, 1))
+
+
 class ConcatSquashLinear(nn.Module):
     def __init__(self, dim_in, dim_out):
         super(ConcatSquashLinear, self).__init__()
@@ -81,8 +146,8 @@ class ConcatSquashLinear(nn.Module):
         self._hyper_gate = nn.Linear(1, dim_out)
 
     def forward(self, t, x):
-        return self._layer(x) * torch.sigmoid(self._hyper_gate(t.view(1, 1))) \
-            + self._hyper_bias(t.view(1, 1))
+        gate, bias = hyper_gate_bias(self, t)
+        return self._layer(x) * gate + bias
 
 
 class HyperConv2d(nn.Module):
@@ -189,8 +254,8 @@ class ConcatSquashConv2d(nn.Module):
         self._hyper_bias = nn.Linear(1, dim_out, bias=False)
 
     def forward(self, t, x):
-        return self._layer(x) * torch.sigmoid(self._hyper_gate(t.view(1, 1))).view(1, -1, 1, 1) \
-            + self._hyper_bias(t.view(1, 1)).view(1, -1, 1, 1)
+        gate, bias = hyper_gate_bias(self, t)
+        return self._layer(x) * gate.view(1, -1, 1, 1) + bias.view(1, -1, 1, 1)
 
 
 class ConcatCoordConv2d(nn.Module):
@@ -11,16 +11,28 @@ __all__ = ["ODEnet", "AutoencoderDiffEqNet", "ODEfunc", "AutoencoderODEfunc"]
 
 
 def divergence_bf(dx, y, **unused_kwargs):
-    sum_diag = 0.
-    for i in range(y.shape[1]):
-        sum_diag += torch.autograd.grad(dx[:, i].sum(), y, create_graph=True)[0].contiguous()[:, i].contiguous()
-    return sum_diag.contiguous()
+    jac = _get_minibatch_jacobian(dx, y)
+    return jac.diagonal(dim1=1, dim2=2).sum(1)
 
 
-# def divergence_bf(f, y, **unused_kwargs):
-#     jac = _get_minibatch_jacobian(f, y)
-#     diagonal = jac.view(jac.shape[0], -1)[:, ::jac.shape[1]]
-#     return torch.sum(diagonal, 1)
+# elements per chunk of batched vector-Jacobian products, larger chunks are
+# slower than one backward pass per vector (~100 dims at batch size 100)
+VJP_CHUNK_ELEMENTS = 2 ** 16
+
+
+def _batched_vjp(f, y, vs):
+    """Returns the stacked v^T (df/dy) for the vectors v of vs [k, *f.shape].
+
+    Chunks of vs are computed by one batched backward pass each, on torch
+    versions without is_grads_batched (< 1.11) every v takes its own."""
+    chunk = VJP_CHUNK_ELEMENTS // max(1, vs[0].numel())
+    if chunk > 1:
+        try:
+            return torch.cat([torch.autograd.grad(f, y, v, retain_graph=True, create_graph=True,
+                                                  is_grads_batched=True)[0] for v in vs.split(chunk)])
+        except TypeError:
+            pass
+    return torch.stack([torch.autograd.grad(f, y, v, retain_graph=True, create_graph=True)[0] for v in vs])
 
 
 def _get_minibatch_jacobian(y, x):
@@ -34,15 +46,11 @@ def _get_minibatch_jacobian(y, x):
     """
     assert y.shape[0] == x.shape[0]
     y = y.view(y.shape[0], -1)
+    n, d = y.shape
 
-    # Compute Jacobian row by row.
-    jac = []
-    for j in range(y.shape[1]):
-        dy_j_dx = torch.autograd.grad(y[:, j], x, torch.ones_like(y[:, j]), retain_graph=True,
-                                      create_graph=True)[0].view(x.shape[0], -1)
-        jac.append(torch.unsqueeze(dy_j_dx, 1))
-    jac = torch.cat(jac, 1)
-    return jac
+    # one vector-Jacobian product per row
+    basis = torch.eye(d).to(y).unsqueeze(1).expand(d, n, d)
+    return _batched_vjp(y, x, basis).view(d, n, -1).transpose(0, 1).contiguous()
 
 
 def divergence_approx(f, y, e=None):
@@ -52,6 +60,24 @@ def divergence_approx(f, y, e=None):
     return approx_tr_dzdx
 
 
+def divergence_colored(f, y, probes):
+    """Exact divergence from one vector-Jacobian product per probe.
+
+    probes [k, D] are the 0/1 indicators of a coloring of the Jacobian
+    sparsity in which no two indices of a color are coupled, see
+    Adjacency.coloring, so e^T (df/dy) e summed over the probes is the trace.
+    """
+    e = probes.unsqueeze(1).expand(-1, y.shape[0], -1)
+    e_dzdx = _batched_vjp(f, y, e)
+    return (e_dzdx * e).sum(dim=(0, 2))
+
+
+def divergence_multiprobe(f, y, e):
+    """Hutchinson estimates e^T (df/dy) e [k, N] of the k probes e [k, *y.shape]."""
+    e_dzdx = _batched_vjp(f, y, e)
+    return (e_dzdx * e).view(e.shape[0], y.shape[0], -1).sum(dim=2)
+
+
 def sample_rademacher_like(y):
     return torch.randint(low=0, high=2, size=y.shape).to(y) * 2 - 1
 
@@ -60,6 +86,28 @@ def sample_gaussian_like(y):
     return torch.randn_like(y)
 
 
+def sample_orthogonal_like(y, num_probes):
+    """num_probes orthogonal probes [k, *y.shape] per batch element, each
+    uniform on the sphere of radius sqrt(D), so that E[e e^T] = I."""
+    n, d = y.shape[0], y[0].numel()
+    assert num_probes <= d, "At most {} orthogonal probes in {} dimensions".format(d, d)
+    qr = getattr(getattr(torch, "linalg", None), "qr", torch.qr)
+    q, r = qr(torch.randn(n, d, num_probes).to(y))
+    # the signs of diag(r) make q Haar distributed
+    q = q * torch.sign(r.diagonal(dim1=1, dim2=2)).unsqueeze(1)
+    return (q * d ** 0.5).permute(2, 0, 1).reshape((num_probes,) + y.shape)
+
+
+def sample_probes_like(y, num_probes=1, probe="gaussian"):
+    """Probes of the Hutchinson estimator, [k, *y.shape] or y.shape for a single probe."""
+    if probe == "orthogonal":
+        e = sample_orthogonal_like(y, num_probes)
+    else:
+        sample = {"gaussian": sample_gaussian_like, "rademacher": sample_rademacher_like}[probe]
+        e = torch.stack([sample(y) for _ in range(num_probes)])
+    return e[0] if num_probes == 1 else e
+
+
 class Swish(nn.Module):
 
     def __init__(self):
@@ -257,9 +305,12 @@ class AutoencoderDiffEqNet(nn.Module):
 
 class ODEfunc(nn.Module):
 
-    def __init__(self, diffeq, divergence_fn="approximate", residual=False, rademacher=False, num_prob=0):
+    def __init__(self, diffeq, divergence_fn="approximate", residual=False, rademacher=False, num_prob=0,
+                 num_probes=1, probe=None):
         super(ODEfunc, self).__init__()
-        assert divergence_fn in ("brute_force", "approximate")
+        assert divergence_fn in ("brute_force", "approximate", "colored")
+        assert probe in (None, "gaussian", "rademacher", "orthogonal")
+        assert num_probes >= 1
 
         # self.diffeq = diffeq_layers.wrappers.diffeq_wrapper(diffeq)
         self.diffeq = diffeq
@@ -267,17 +318,46 @@ class ODEfunc(nn.Module):
         self.rademacher = rademacher
         assert num_prob >= 0
         self.num_prob = num_prob
+        # several probes of the approximate divergence share one batched
+        # vector-Jacobian product, their spread is kept per solve
+        self.num_probes = num_probes
+        self.probe = probe if probe is not None else "rademacher" if rademacher else "gaussian"
 
         if divergence_fn == "brute_force":
             self.divergence_fn = divergence_bf
         elif divergence_fn == "approximate":
             self.divergence_fn = divergence_approx
+        elif divergence_fn == "colored":
+            assert hasattr(diffeq, "coloring_probes"), \
+                "Colored divergence needs the Jacobian sparsity of the net, {} has none".format(type(diffeq).__name__)
+            self.divergence_fn = divergence_colored
 
         self.register_buffer("_num_evals", torch.tensor(0.))
+        self._jac = None
+        self._variance = 0.
 
     def before_odeint(self, e=None):
         self._e = e
+        self._jac = None
+        self._variance = 0.
         self._num_evals.fill_(0)
+        self.clear_caches()
+
+    def clear_caches(self):
+        """Drops the values the diffeq caches for a solve, whose graph nodes
+        are shared by all evaluations until then."""
+        if hasattr(self.diffeq, "before_odeint"):
+            self.diffeq.before_odeint()
+
+    def divergence_variance(self):
+        """Mean variance of the multi-probe divergence estimate per evaluation
+        since before_odeint, estimated from the spread of the probes, or
+        None with a single probe. Also None for orthogonal probes, which are
+        not independent, so the spread says nothing about the variance of
+        their mean."""
+        if self.num_probes == 1 or self.divergence_fn is not divergence_approx or self.probe == "orthogonal":
+            return None
+        return float(self._variance) / max(self._num_evals.item(), 1)
 
     def forward(self, t, states):
         assert len(states) >= 2
@@ -286,29 +366,41 @@ class ODEfunc(nn.Module):
         # increment num evals
         self._num_evals += 1
 
-        # convert to tensor
-        t = torch.tensor(t).type_as(y)
+        # convert to tensor, detach shares the storage of the solver's time
+        t = torch.as_tensor(t).detach().type_as(y)
         batchsize = y.shape[0]
 
         # Sample and fix the noise.
         if self._e is None:
-            if self.rademacher:
-                self._e = sample_rademacher_like(y)
-            else:
-                self._e = sample_gaussian_like(y)
+            self._e = sample_probes_like(y, self.num_probes, self.probe)
 
         with torch.set_grad_enabled(True):
             y.requires_grad_(True)
             t.requires_grad_(True)
             for s_ in states[2:]:
                 s_.requires_grad_(True)
-            dy = self.diffeq(t, y, *states[2:])
+            if self.divergence_fn is divergence_bf and hasattr(self.diffeq, "jacobian") and len(states) == 2:
+                # exact Jacobian propagated through the layers with the forward
+                # pass, kept for the Jacobian regularizers
+                dy, self._jac = self.diffeq.jacobian(t, y)
+            else:
+                dy, self._jac = self.diffeq(t, y, *states[2:]), None
             # Hack for 2D data to use brute force divergence computation.
             #if not self.training and dy.view(dy.shape[0], -1).shape[1] == 2:
             #    divergence = divergence_bf(dy, y).view(batchsize, 1)
             #else:
             #divergence = self.divergence_fn(dy, y, e=self._e, num_prob=num_prob).view(batchsize, 1)
-            divergence = self.divergence_fn(dy, y, e=self._e).view(batchsize, 1)
+            if self._jac is not None:
+                divergence = self._jac.diagonal(dim1=1, dim2=2).sum(1).view(batchsize, 1)
+            elif self.divergence_fn is divergence_colored:
+                divergence = divergence_colored(dy, y, self.diffeq.coloring_probes().to(y)).view(batchsize, 1)
+            elif self.divergence_fn is divergence_approx and self._e.dim() > y.dim():
+                estimates = divergence_multiprobe(dy, y, self._e)
+                if self.probe != "orthogonal":
+                    self._variance += estimates.detach().var(dim=0).mean() / estimates.shape[0]
+                divergence = estimates.mean(dim=0).view(batchsize, 1)
+            else:
+                divergence = self.divergence_fn(dy, y, e=self._e).view(batchsize, 1)
         if self.residual:
             dy = dy - y
             divergence -= torch.ones_like(divergence) * torch.tensor(np.prod(y.shape[1:]), dtype=torch.float32
@@ -338,8 +430,8 @@ class AutoencoderODEfunc(nn.Module):
         # increment num evals
         self._num_evals += 1
 
-        # convert to tensor
-        t = torch.tensor(t).type_as(y)
+        # convert to tensor, detach shares the storage of the solver's time
+        t = torch.as_tensor(t).detach().type_as(y)
         batchsize = y.shape[0]
 
         with torch.set_grad_enabled(True):
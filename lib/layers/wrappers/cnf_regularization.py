@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 
+from ..odefunc import _get_minibatch_jacobian
+
 
 class RegularizedODEfunc(nn.Module):
     def __init__(self, odefunc, regularization_fns):
@@ -11,6 +13,9 @@ class RegularizedODEfunc(nn.Module):
     def before_odeint(self, *args, **kwargs):
         self.odefunc.before_odeint(*args, **kwargs)
 
+    def clear_caches(self):
+        self.odefunc.clear_caches()
+
     def forward(self, t, state):
         class SharedContext(object):
             pass
@@ -22,7 +27,10 @@ class RegularizedODEfunc(nn.Module):
             dstate = self.odefunc(t, (x, logp))
             if len(state) > 2:
                 dx, dlogp = dstate[:2]
-                reg_states = tuple(reg_fn(t, x, logp, dx, dlogp, SharedContext) for reg_fn in self.regularization_fns)
+                if getattr(self.odefunc, "_jac", None) is not None:
+                    # exact Jacobian the odefunc already built for the divergence
+                    SharedContext.jac = self.odefunc._jac
+                reg_states = tuple(reg_fn(x, logp, dx, dlogp, SharedContext) for reg_fn in self.regularization_fns)
                 return dstate + reg_states
             else:
                 return dstate
@@ -85,25 +93,3 @@ def jacobian_offdiag_frobenius_regularization_fn(x, logp, dx, dlogp, context):
     ss_offdiag = torch.sum(jac.view(jac.shape[0], -1)**2, dim=1) - torch.sum(diagonal**2, dim=1)
     ms_offdiag = ss_offdiag / (diagonal.shape[1] * (diagonal.shape[1] - 1))
     return torch.mean(ms_offdiag)
-
-
-def _get_minibatch_jacobian(y, x, create_graph=False):
-    """Computes the Jacobian of y wrt x assuming minibatch-mode.
-
-    Args:
-      y: (N, ...) with a total of D_y elements in ...
-      x: (N, ...) with a total of D_x elements in ...
-    Returns:
-      The minibatch Jacobian matrix of shape (N, D_y, D_x)
-    """
-    assert y.shape[0] == x.shape[0]
-    y = y.view(y.shape[0], -1)
-
-    # Compute Jacobian row by row.
-    jac = []
-    for j in range(y.shape[1]):
-        dy_j_dx = torch.autograd.grad(y[:, j], x, torch.ones_like(y[:, j]), retain_graph=True,
-                                      create_graph=True)[0].view(x.shape[0], -1)
-        jac.append(torch.unsqueeze(dy_j_dx, 1))
-    jac = torch.cat(jac, 1)
-    return jac
@@ -6,11 +6,14 @@ import torch.optim as optim
 from math import sqrt
 
 from itertools import chain
-from flow import create_cnf, compute_loss, create_batch, get_transforms
+from flow import create_cnf, compute_loss, training_loss, create_batch, get_transforms, streaming_statistics
+from flow import scheduled_tolerances, set_tolerances
 
 from nets import AdaptedODENet, SparseODENet, ODENet
+from prefetch import BatchPrefetcher
+from sample_store import SampleStore
 
-import models
+from registry import create_model, construction_times
 
 from types import SimpleNamespace
 
@@ -44,9 +47,80 @@ def my_config():
     gmodel_name = 'gaussian_bn'
     flow_connectivity = "fully_connected"
     loss_choice = "forward"
+    # number of flow samples per simulated observation in the reverse KL term
     repeat_samples = 1
     integration_times = [0.0, 1.0]
 
+    # background simulation of minibatches: "none", "thread" or "process",
+    # threads share the global RNG and are not reproducible from the seed
+    prefetch_backend = "none"
+    prefetch_workers = 1
+    prefetch_queue_size = 4
+
+    # directory of memory-mapped simulated (x, y) pairs reused across runs,
+    # simulated with sample_store_seed independently of the training seed
+    sample_store = None
+    sample_store_size = 100000
+    sample_store_seed = 0
+
+    # number of simulated pairs for the normalization statistics, drawn with
+    # their own seed and cached per model in the directory stats_cache if given
+    stats_samples = 10000
+    stats_seed = 0
+    stats_cache = None
+
+    # trace densities and sampler of the model into TorchScript
+    jit_model = False
+
+    # masked layers of the sparse flows: "dense", "sparse" (gather-scatter) or "auto" by mask density
+    sparse_mode = "auto"
+
+    # evaluate the ODE right hand side with divergence as one TorchScript call
+    # (fully_connected and faithful flows only)
+    jit_rhs = False
+
+    # divergence of the flow: "approximate" (Hutchinson), "brute_force"
+    # (exact, the Jacobian is propagated through the layers of the
+    # fully_connected and faithful flows) or "colored" (exact, one
+    # vector-Jacobian product per color of the Jacobian sparsity of the
+    # faithful flows)
+    divergence_fn = "approximate"
+
+    # probes of the approximate divergence per solve, "gaussian",
+    # "rademacher" or "orthogonal", several are evaluated as one batched
+    # vector-Jacobian product and their variance is logged
+    num_probes = 1
+    probe = "gaussian"
+
+    # ODE solver of the flows in training and in evaluation (cnf.eval()),
+    # step_size is the step of the fixed grid solvers (euler, midpoint,
+    # rk4), first_step and max_num_steps control the adaptive ones, None
+    # keeps the torchdiffeq defaults
+    solver = "dopri5"
+    atol = 1e-5
+    rtol = 1e-5
+    step_size = None
+    first_step = None
+    max_num_steps = None
+    test_solver = "dopri5"
+    test_atol = 1e-5
+    test_rtol = 1e-5
+    test_step_size = None
+
+    # training tolerances by progress, entries [fraction of train_steps, atol, rtol]
+    # replace atol and rtol from that step on, e.g. loose to tight:
+    # [[0.0, 1e-3, 1e-3], [0.5, 1e-4, 1e-4], [0.9, 1e-5, 1e-5]]
+    tol_schedule = []
+
+    # gradients of the solves: "adjoint" solves the adjoint ODE backwards,
+    # "direct" backpropagates through the stored solver steps, which saves
+    # the backward evaluations, "auto" uses direct while the estimated graphs
+    # of both solves of a step fit into memory_budget_mb, "checkpoint" (dopri5 only)
+    # stores the solver state of each step and recomputes one step at a
+    # time in the backward pass
+    backprop_mode = "adjoint"
+    memory_budget_mb = 1024
+
     device = "cpu"
 
 
@@ -63,11 +137,20 @@ def log_scalar(name, scalar, step=None, _run=None):
         _run.log_scalar(name, scalar)
 
 
+def solver_options(args, step_size):
+    options = dict(step_size=step_size, first_step=args.first_step, max_num_steps=args.max_num_steps)
+    return {k: v for k, v in options.items() if v is not None}
+
+
 def init(seed, config, _run):
     seed_all(seed)
     args = SimpleNamespace(**config)
     args._run = _run
 
+    if args.prefetch_backend == "process" and args.jit_model:
+        raise Exception("Traced models cannot be pickled into prefetch processes, "
+                        "use prefetch_backend='thread' or 'none' with jit_model")
+
     args.device = torch.device("cpu") if args.device == "cpu" else getFreeGPU()
     print("Using device:", args.device)
 
@@ -75,78 +158,58 @@ def init(seed, config, _run):
     args.integration_times = torch.tensor(args.integration_times).to(args.device)
 
 
-    if args.gmodel_name.startswith("autogen"):
-        autogen_models = __import__(args.gmodel_name, fromlist="*")
-        args.gmodel = autogen_models.FlowModel()
-    elif args.gmodel_name == "gaussian_bn":
-        args.gmodel = models.GaussianBayesianNetwork()
-    elif args.gmodel_name == "crazy1d":
-        args.gmodel = models.Crazy1D()
-    elif args.gmodel_name == "circle":
-        args.gmodel = models.CircleModel()
-    elif args.gmodel_name == "state_space":
-        args.gmodel = models.StateSpaceModel()
-    elif args.gmodel_name == "state_space_larger":
-        args.gmodel = models.StateSpaceModelLarger()
-    elif args.gmodel_name == "8gaussians":
-        args.gmodel = models.ToyData("8gaussians")
-    elif args.gmodel_name == "rings":
-        args.gmodel = models.ToyData("rings")
-    elif args.gmodel_name == "swissroll":
-        args.gmodel = models.ToyData("swissroll")
-    elif args.gmodel_name == "bigger_graph1":
-        args.gmodel = models.BiggerGraph1()
-    elif args.gmodel_name == "bigger_graph2":
-        args.gmodel = models.BiggerGraph2()
-    elif args.gmodel_name == "bigger_graph3":
-        args.gmodel = models.BiggerGraph3()
-    elif args.gmodel_name == "bigger_graph4":
-        args.gmodel = models.BiggerGraph4()
-    elif args.gmodel_name == "bigger_graph5":
-        args.gmodel = models.BiggerGraph5()
-    elif args.gmodel_name == "bigger_graph6":
-        args.gmodel = models.BiggerGraph6()
-    elif args.gmodel_name == "simple_arith_circuit":
-        args.gmodel = models.SimpleArithmeticCircuit()
-    elif args.gmodel_name == "ber_gmm":
-        args.gmodel = models.BernoulliGMM()
-
-    else:
-        raise Exception("Model unknown: {}".format(args.gmodel_name))
+    args.gmodel = create_model(args.gmodel_name)
+    log_scalar("model_construction_time", construction_times[args.gmodel_name])
 
     if len(args.to_augment) > 0:
         print("Augmenting rvars: ", args.to_augment)
-        args.gmodel = models.AugmentedModel(args.gmodel, args.to_augment)
+        from models import AugmentedModel
+        args.gmodel = AugmentedModel(args.gmodel, args.to_augment)
         #print("Faithful inversion: ", args.gmodel.faithful_adjacency)
 
+    if args.jit_model:
+        from jit_model import ScriptedModel
+        args.gmodel = ScriptedModel(args.gmodel, args.batch_size, args.device)
+
     args.dim_latent = args.gmodel.dim_latent
     args.dim_condition = args.gmodel.dim_condition
 
     min_std = 1e-5
 
-    xs, ys = create_batch(args.gmodel.sample, 10000)
-    xstd = torch.std(xs, dim=0).to(args.device)
+    cache_path = None
+    if args.stats_cache is not None:
+        augment = "-".join(str(i) for i in args.to_augment) or "none"
+        cache_path = os.path.join(args.stats_cache, "{}_aug{}_seed{}_{}x{}_{}.th".format(
+            args.gmodel_name, augment, args.stats_seed, args.dim_latent, args.dim_condition,
+            args.stats_samples))
+    xmean, xstd, ymean, ystd = streaming_statistics(args.gmodel.sample, args.stats_samples,
+                                                    cache_path=cache_path, seed=args.stats_seed)
+    xstd = xstd.to(args.device)
     xscale = torch.max(xstd, torch.ones_like(xstd)*min_std)
     args.xscale = xscale
-    args.xshift = torch.mean(xs, dim=0).to(args.device)
-    ystd = torch.std(ys, dim=0).to(args.device)
+    args.xshift = xmean.to(args.device)
+    ystd = ystd.to(args.device)
     yscale = torch.max(ystd, torch.ones_like(ystd)*min_std)
     args.yscale = yscale
-    args.yshift = torch.mean(ys, dim=0).to(args.device)
+    args.yshift = ymean.to(args.device)
 
 
     if args.flow_connectivity == "fully_connected":
         args.diffeq = AdaptedODENet(args.dim_latent, args.dim_condition)
 
     elif args.flow_connectivity == "faithful":
-        args.diffeq = SparseODENet(args.dim_latent, args.dim_condition, args.gmodel.faithful_adjacency, args.device)
+        args.diffeq = SparseODENet(args.dim_latent, args.dim_condition, args.gmodel.faithful_adjacency, args.device,
+                                   sparse_mode=args.sparse_mode)
     elif args.flow_connectivity == "faithful_large":
-        args.diffeq = SparseODENet(args.dim_latent, args.dim_condition, args.gmodel.faithful_adjacency, args.device, num_layers=8)
+        args.diffeq = SparseODENet(args.dim_latent, args.dim_condition, args.gmodel.faithful_adjacency, args.device, num_layers=8,
+                                   sparse_mode=args.sparse_mode)
     elif args.flow_connectivity == "faithful_small":
-        args.diffeq = SparseODENet(args.dim_latent, args.dim_condition, args.gmodel.faithful_adjacency, args.device, num_layers=2)
+        args.diffeq = SparseODENet(args.dim_latent, args.dim_condition, args.gmodel.faithful_adjacency, args.device, num_layers=2,
+                                   sparse_mode=args.sparse_mode)
 
     elif args.flow_connectivity == "random_sparse":
-        args.diffeq = SparseODENet(args.dim_latent, args.dim_condition, args.gmodel.rand_adjacency, args.device)
+        args.diffeq = SparseODENet(args.dim_latent, args.dim_condition, args.gmodel.rand_adjacency, args.device,
+                                   sparse_mode=args.sparse_mode)
     elif args.flow_connectivity == "ffjord_baseline":
         # default arguments from train_misc.py and train_toy.py
         args.diffeq = ODENet(hidden_dims=(64, 64, 64),
@@ -158,10 +221,19 @@ def init(seed, config, _run):
 
 
     args.diffeq.to(args.device)
-    args.diffeq.conditioned = ys[0:args.batch_size]
 
     args.cnf = create_cnf(
-        args.diffeq, regularization_fns=None).to(args.device)
+        args.diffeq, regularization_fns=None, scripted=args.jit_rhs,
+        divergence_fn=args.divergence_fn, num_probes=args.num_probes, probe=args.probe,
+        solver_settings=dict(solver=args.solver, atol=args.atol, rtol=args.rtol,
+                             solver_options=solver_options(args, args.step_size),
+                             test_solver=args.test_solver, test_atol=args.test_atol, test_rtol=args.test_rtol,
+                             test_solver_options=solver_options(args, args.test_step_size)),
+        backprop_mode=args.backprop_mode, memory_budget=args.memory_budget_mb * 2 ** 20
+    ).to(args.device)
+
+    if args.divergence_fn == "colored":
+        log_scalar("divergence_probes", args.diffeq.coloring_probes().shape[0])
 
     return args
 
@@ -176,64 +248,75 @@ def experiment(_seed, _config, _run):
 
     cnf.train()
 
-    moving_sym_kl = None
-    for i in range(args.train_steps):
-        if i == int(0.5*args.train_steps):
-            for g in optimizer.param_groups:
-                g['lr'] = g['lr']*0.1
-                log_scalar("learning_rate", g['lr'], i)
-
-        if i == int(0.8*args.train_steps):
-            for g in optimizer.param_groups:
-                g['lr'] = g['lr']*0.1
-                log_scalar("learning_rate", g['lr'], i)
-
-        if i == int(0.95*args.train_steps):
-            for g in optimizer.param_groups:
-                g['lr'] = g['lr']*0.5
-                log_scalar("learning_rate", g['lr'], i)
-
-
-        optimizer.zero_grad()
-
-        res = compute_loss(args, log_scalar)
-        if args.loss_choice == "forward":
-            res.forward_kl.backward()
-        if args.loss_choice == "backward":
-            res.reverse_kl.backward()
-        if args.loss_choice == "sym":
-            #rescale_reverse = forward_kl.item()/reverse_kl.item()
-            (res.forward_kl + res.reverse_kl).backward()
-        if args.loss_choice == "sym_reg":
-            # Only reverse KL makes sense for angles because logp is only known in this case
-            (res.forward_kl + res.reverse_kl + (res.reverse_reg[0][1])).backward()
-        if args.loss_choice == "forw_reg":
-            # Only reverse KL makes sense for angles because logp is only known in this case
-            (res.forward_kl + res.reverse_reg[0][1]).backward()
-        if args.loss_choice == "reg_only":
-            forward_vel = res.forward_reg[1][1]
-            forward_angle = res.forward_reg[0][1]
-            reverse_vel = res.reverse_reg[1][1]
-            reverse_angle = res.reverse_reg[0][1]
-            (reverse_angle).backward()
-
-        log_scalar("forward_kl", res.forward_kl.item())
-        log_scalar("reverse_kl", res.reverse_kl.item())
-        log_scalar("backprop_solver_evals", cnf.num_evals())
-        log_scalar("forward_solver_evals", res.forward_num_evals)
-        log_scalar("reverse_solver_evals", res.reverse_num_evals)
-        if moving_sym_kl is None:
-            moving_sym_kl = 0.5*(res.forward_kl.item() + res.reverse_kl.item())
-        else:
-            moving_sym_kl = max(0.95*moving_sym_kl + 0.05*(0.5*(res.forward_kl.item() + res.reverse_kl.item())), 1e-5)
-        log_scalar("moving_sym_kl", moving_sym_kl)
-
-        if i % 500 == 0:
-            torch.save(cnf.state_dict(), f"./{i}_flow.th")
-            ex.add_artifact(f"./{i}_flow.th")
-        #log_scalar("reg_states", cnf.get_regularization_states())
-
-        optimizer.step()
+    batches = None
+    if args.sample_store is not None:
+        augment = "-".join(str(i) for i in args.to_augment)
+        store = SampleStore(args.sample_store, args.gmodel_name + ("_aug" + augment if augment else ""),
+                            args.sample_store_seed, args.dim_latent, args.dim_condition)
+        if not store.exists():
+            print("Simulating {} samples into {}".format(args.sample_store_size, store.path))
+            store.fill(args.gmodel, args.sample_store_size)
+        batches = store.batches(args.batch_size, seed=_seed)
+    elif args.prefetch_backend != "none":
+        batches = BatchPrefetcher(args.gmodel, args.batch_size,
+                                  num_workers=args.prefetch_workers,
+                                  queue_size=args.prefetch_queue_size,
+                                  backend=args.prefetch_backend,
+                                  seed=_seed).start()
+
+    try:
+        moving_sym_kl = None
+        for i in range(args.train_steps):
+            if i == int(0.5*args.train_steps):
+                for g in optimizer.param_groups:
+                    g['lr'] = g['lr']*0.1
+                    log_scalar("learning_rate", g['lr'], i)
+
+            if i == int(0.8*args.train_steps):
+                for g in optimizer.param_groups:
+                    g['lr'] = g['lr']*0.1
+                    log_scalar("learning_rate", g['lr'], i)
+
+            if i == int(0.95*args.train_steps):
+                for g in optimizer.param_groups:
+                    g['lr'] = g['lr']*0.5
+                    log_scalar("learning_rate", g['lr'], i)
+
+
+            tolerances = scheduled_tolerances(args.tol_schedule, i, args.train_steps, (args.atol, args.rtol))
+            if tolerances != (cnf.atol, cnf.rtol):
+                set_tolerances(cnf, *tolerances)
+                log_scalar("atol", tolerances[0], i)
+                log_scalar("rtol", tolerances[1], i)
+
+            optimizer.zero_grad()
+
+            res = compute_loss(args, log_scalar,
+                               next(batches) if batches is not None else None)
+            training_loss(res, args.loss_choice).backward()
+
+            log_scalar("forward_kl", res.forward_kl.item())
+            log_scalar("reverse_kl", res.reverse_kl.item())
+            log_scalar("backprop_solver_evals", cnf.num_evals())
+            if hasattr(args.diffeq, "num_weight_builds"):
+                log_scalar("backprop_weight_builds", args.diffeq.num_weight_builds())
+            log_scalar("forward_solver_evals", res.forward_num_evals)
+            log_scalar("reverse_solver_evals", res.reverse_num_evals)
+            if moving_sym_kl is None:
+                moving_sym_kl = 0.5*(res.forward_kl.item() + res.reverse_kl.item())
+            else:
+                moving_sym_kl = max(0.95*moving_sym_kl + 0.05*(0.5*(res.forward_kl.item() + res.reverse_kl.item())), 1e-5)
+            log_scalar("moving_sym_kl", moving_sym_kl)
+
+            if i % 500 == 0:
+                torch.save(cnf.state_dict(), f"./{i}_flow.th")
+                ex.add_artifact(f"./{i}_flow.th")
+            #log_scalar("reg_states", cnf.get_regularization_states())
+
+            optimizer.step()
+    finally:
+        if batches is not None:
+            batches.close()
 
     filename = "./final_flow.th"
     torch.save(cnf.state_dict(), filename)
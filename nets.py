@@ -12,6 +12,8 @@ from tqdm import tqdm
 import copy
 from torch import squeeze, unsqueeze
 import lib.layers.diffeq_layers as diffeq_layers
+from adjacency import Adjacency
+from recorder import TrajectoryRecorder
 
 
 class ConcatSquashLinear(nn.Module):
@@ -20,75 +22,236 @@ class ConcatSquashLinear(nn.Module):
         self._layer = nn.Linear(dim_in, dim_out)
         self._hyper_bias = nn.Linear(1, dim_out, bias=False)
         self._hyper_gate = nn.Linear(1, dim_out)
+        _clear_cache(self)
 
-    def forward(self, t, x):
+    def forward(self, t, x, y=None):
         time = t.view(1, 1).to(x.device)
-        return self._layer(x) * torch.sigmoid(self._hyper_gate(time)) \
-            + self._hyper_bias(time)
+        res = self._layer(x) if y is None else _split_linear(self, x, y, time)
+        gate, bias = diffeq_layers.hyper_gate_bias(self, t.to(x.device))
+        return res * gate + bias
+
+
+# masks sparser than this use the gather-scatter kernel in "auto" mode, above
+# it the dense masked addmm is faster (see benchmarks.py, ~1% on CPU)
+SPARSE_DENSITY_THRESHOLD = 0.01
+
+
+def _init_masked_weight(module, dim_in, dim_out, adjacency, device, mode):
+    """Sets up the weights of a masked linear layer.
+
+    In dense mode the full weight matrix is multiplied with the mask on
+    every call. In sparse mode only the unmasked entries are parameters and
+    the product is computed by gathering the inputs of every edge and
+    scattering them into the outputs, so cost and memory are O(nnz)."""
+    assert mode in ("auto", "dense", "sparse")
+    module._adjacency = Adjacency.coerce(adjacency).crop(dim_out, dim_in)
+    module.density = len(module._adjacency) / float(dim_out * dim_in)
+    module.sparse = mode == "sparse" or (mode == "auto" and module.density < SPARSE_DENSITY_THRESHOLD)
+
+    lin = nn.Linear(dim_in, dim_out)
+    module._bias = lin.bias
+    if module.sparse:
+        rows, cols = module._adjacency.indices()
+        module.register_buffer("_rows", rows.to(device))
+        module.register_buffer("_cols", cols.to(device))
+        module._values = nn.Parameter(lin.weight.data[rows, cols].clone())
+    else:
+        module._weight_mask = module._adjacency.mask(dim_out, dim_in, device)
+        module._weights = lin.weight
+    _clear_cache(module)
+
+
+def _load_masked_weight(module, state_dict, prefix):
+    """Converts the weights of a state_dict saved in the other mode in
+    place, so that dense and sparse layers load each other's checkpoints."""
+    if module.sparse and prefix + "_weights" in state_dict:
+        weights = state_dict.pop(prefix + "_weights")
+        state_dict[prefix + "_values"] = weights[module._rows, module._cols]
+        state_dict.setdefault(prefix + "_rows", module._rows)
+        state_dict.setdefault(prefix + "_cols", module._cols)
+    elif not module.sparse and prefix + "_values" in state_dict:
+        values = state_dict.pop(prefix + "_values")
+        rows, cols = state_dict.pop(prefix + "_rows"), state_dict.pop(prefix + "_cols")
+        weights = values.new_zeros(module.dim_out, module.dim_in)
+        weights[rows, cols] = values
+        state_dict[prefix + "_weights"] = weights
+
+
+def _clear_cache(module):
+    module._cache = {}
+    module.weight_builds = 0
+
+
+def _cached(module, name, key, fn):
+    """Returns fn(), recomputed only when key differs from the last call.
+
+    Keys hold the version counters of the tensors fn reads, which every
+    in-place update such as optimizer.step bumps, and the grad mode, so
+    that a value computed under no_grad is never reused for training. All
+    evaluations of a solve, including the adjoint pass, share one node of
+    the graph, callers outside of odeint have to call before_odeint after
+    each backward pass."""
+    entry = module._cache.get(name)
+    if entry is None or entry[0] != key:
+        entry = module._cache[name] = (key, fn())
+    return entry[1]
+
+
+def _masked_weight(module):
+    """Returns (mask * weights)^T, computed once per solve."""
+    def build():
+        module.weight_builds += 1
+        return torch.mul(module._weight_mask, module._weights).transpose(0,1)
+    return _cached(module, "weight", (module._weights._version, torch.is_grad_enabled()), build)
+
+
+def _dense_weight(module):
+    """Returns the transposed [dim_in, dim_out] weight and the bias of a
+    ConcatSquash layer, sparse values are scattered once per solve."""
+    if hasattr(module, "_layer"):
+        return module._layer.weight.transpose(0,1), module._layer.bias
+    if module.sparse:
+        def build():
+            weight = module._values.new_zeros(module.dim_in, module.dim_out)
+            return weight.index_put((module._cols, module._rows), module._values)
+        return _cached(module, "dense", (module._values._version, torch.is_grad_enabled()), build), module._bias
+    return _masked_weight(module), module._bias
+
+
+def _scatter(module, inputs, rows, cols, values):
+    # gather and scatter whole rows of inputs^T, contiguous over the batch
+    edges = inputs.t()[cols] * values.unsqueeze(1)
+    return inputs.new_zeros(module.dim_out, inputs.shape[0]).index_add(0, rows, edges).t()
+
+
+def _masked_linear(module, x):
+    if module.sparse:
+        return _scatter(module, x, module._rows, module._cols, module._values) + module._bias
+    return torch.addmm(module._bias, x, _masked_weight(module))
+
+
+def _edge_groups(module, n, m):
+    # edges reading x = inputs[:n], y = inputs[n:n+m] and t = inputs[n+m:]
+    groups = []
+    for lo, hi in ((0, n), (n, n + m), (n + m, module.dim_in)):
+        index = ((module._cols >= lo) & (module._cols < hi)).nonzero().squeeze(1)
+        groups.append((module._rows[index], module._cols[index] - lo, module._values[index]))
+    return groups
+
+
+def _split_linear(module, x, y, t):
+    """Linear part of the layer applied to cat([x, y, t]) without the concatenation.
+
+    y, the conditioning of the flow, is constant during a solve, so its
+    projection plus the bias is cached and only x and t enter every
+    evaluation."""
+    n, m = x.shape[1], y.shape[1]
+    grad = torch.is_grad_enabled()
+    if getattr(module, "sparse", False):
+        version = module._values._version
+        (xr, xc, xv), (yr, yc, yv), (tr, tc, tv) = _cached(
+            module, "groups", (n, m, version, grad), lambda: _edge_groups(module, n, m))
+        # y is kept in the entry so that its id is not reused
+        _, projection = _cached(
+            module, "projection", (id(y), y._version, version, module._bias._version, grad),
+            lambda: (y, _scatter(module, y, yr, yc, yv) + module._bias))
+        out = projection + _scatter(module, x, xr, xc, xv)
+        if len(tv) > 0:
+            out = out + t.view(1, 1) * t.new_zeros(module.dim_out).index_add(0, tr, tv)
+        return out
+
+    if hasattr(module, "_layer"):
+        weight, bias = module._layer.weight.transpose(0,1), module._layer.bias
+        version = module._layer.weight._version
+    else:
+        weight, bias = _masked_weight(module), module._bias
+        version = module._weights._version
+    _, projection = _cached(
+        module, "projection", (id(y), y._version, version, bias._version, grad),
+        lambda: (y, torch.addmm(bias, y, weight[n:n + m])))
+    out = torch.addmm(projection, x, weight[:n])
+    if weight.shape[0] > n + m:
+        out = out + t.view(1, 1) * weight[n + m:]
+    return out
 
 
 class ConcatSquashLinearSparse(nn.Module):
-    def __init__(self, dim_in, dim_out, adjacency, device):
+    def __init__(self, dim_in, dim_out, adjacency, device, mode="auto"):
         super(ConcatSquashLinearSparse, self).__init__()
 
         self.dim_in = dim_in
         self.dim_out = dim_out
 
-        self._adjacency = adjacency
-        _weight_mask = torch.zeros([dim_out, dim_in])
-        for [a, b] in adjacency:
-            if b < dim_in:
-                _weight_mask[a, b] = 1.0
-        print("weight_mask: ")
-        print(_weight_mask)
-        self._weight_mask = _weight_mask.to(device)
-
-        lin = nn.Linear(dim_in, dim_out)
-        self._weights = lin.weight
-        self._bias = lin.bias
+        _init_masked_weight(self, dim_in, dim_out, adjacency, device, mode)
 
         self._hyper_bias = nn.Linear(1, dim_out, bias=False)
         self._hyper_gate = nn.Linear(1, dim_out)
 
-    def forward(self, t, x):
-        w = torch.mul(self._weight_mask, self._weights)
-        res = torch.addmm(self._bias, x, w.transpose(0,1))
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _load_masked_weight(self, state_dict, prefix)
+        super(ConcatSquashLinearSparse, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        return res * torch.sigmoid(self._hyper_gate(t.view(1, 1))) \
-            + self._hyper_bias(t.view(1, 1))
+    def forward(self, t, x, y=None):
+        res = _masked_linear(self, x) if y is None else _split_linear(self, x, y, t)
+        gate, bias = diffeq_layers.hyper_gate_bias(self, t)
+
+        return res * gate + bias
 
 
 class LinearSparse(nn.Module):
-    def __init__(self, dim_in, dim_out, adjacency, device):
+    def __init__(self, dim_in, dim_out, adjacency, device, mode="auto"):
         super(LinearSparse, self).__init__()
 
         self.dim_in = dim_in
         self.dim_out = dim_out
 
-        self._adjacency = adjacency
-        _weight_mask = torch.zeros([dim_out, dim_in])
         #weight_rescale = dim_out*(dim_in + dim_out)/len(adjacency)
-        for [a, b] in adjacency:
-            if b < dim_in:
-                _weight_mask[a, b] = 1.0 # weight_rescale
-        print("weight_mask: ")
-        print(_weight_mask)
-
-        # replicate x dimensions for dx part
-        self._weight_mask = _weight_mask
+        _init_masked_weight(self, dim_in, dim_out, adjacency, device, mode)
 
-        lin = nn.Linear(dim_in, dim_out)
-        self._weights = lin.weight
-        self._bias = lin.bias
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _load_masked_weight(self, state_dict, prefix)
+        super(LinearSparse, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
     def forward(self, x):
-        w = torch.mul(self._weight_mask, self._weights)
-        res = torch.addmm(self._bias, x, w.transpose(0,1))
+        res = _masked_linear(self, x)
 
         return res
 
 
+def _concat_squash_forward(net, t, x, jacobian=False):
+    """Runs the ConcatSquash layers of AdaptedODENet or SparseODENet.
+
+    Returns dx and, if jacobian is set, d dx / dx [batch, dim, dim]
+    propagated through the layers alongside, otherwise None. Every layer
+    multiplies it by its gated weight and every tanh by 1 - tanh^2, which
+    for the small latent dimensions of the models is far cheaper than a
+    backward pass per dimension."""
+    # the first layer reads cat([x, net.conditioned, t]), see _split_linear
+    dx, jac = x, None
+    for l, layer in enumerate(net.layers):
+        acti = layer(t, dx, net.conditioned if l == 0 else None)
+        if jacobian:
+            gate, _ = diffeq_layers.hyper_gate_bias(layer, t.to(x.device))
+            linear = gate.view(-1, 1) * _dense_weight(layer)[0][:dx.shape[1]].transpose(0,1)
+            jac_acti = linear if jac is None else torch.matmul(linear, jac)
+        # if not last layer, use nonlinearity
+        if l < len(net.layers) - 1:
+            h = net.activation_fns[l](acti)
+            if jacobian:
+                jac_h = (1 - h * h).unsqueeze(2) * jac_acti
+                jac = jac_h if l == 0 else jac + jac_h
+            dx = h if l == 0 else dx + h
+        else:
+            dx = acti
+            if jacobian:
+                jac = jac_acti.expand(x.shape[0], -1, -1) if jac_acti.dim() == 2 else jac_acti
+
+    if net.is_recording:
+        net.recorder.record(t, dx, x)
+    return dx, jac
+
+
 class AdaptedODENet(nn.Module):
     def __init__(self, dims, conditional_dims, num_layers=4):
         super(AdaptedODENet, self).__init__()
@@ -97,59 +260,75 @@ class AdaptedODENet(nn.Module):
         activation_fns = [nn.Tanh() for _ in range(num_layers)]
         self.layers = nn.ModuleList(layers)
         self.activation_fns = nn.ModuleList(activation_fns[:-1])
-        self.record = []
+        self.time_conditioning = diffeq_layers.TimeConditioning(self.layers)
+        self.recorder = TrajectoryRecorder()
         self.is_recording = False
 
+    def before_odeint(self):
+        # called by ODEfunc at the start of every solve, drops the
+        # conditioning projection and time gates of the previous solve
+        for layer in self.layers:
+            _clear_cache(layer)
+        self.time_conditioning.clear()
+
     def forward(self, t, x):
-        batch_dim = x.shape[0]
-        #dx = torch.cat([x, self.conditioned], dim=1)
-        dx = torch.cat([x, self.conditioned, t * torch.ones([batch_dim, 1]).to(x.device)], dim=1)
-        for l, layer in enumerate(self.layers):
-            # if not last layer, use nonlinearity
-            if l < len(self.layers) - 1:
-                acti = layer(t, dx)
-                if l == 0:
-                    dx = self.activation_fns[l](acti)
-                else:
-                    dx = self.activation_fns[l](acti) + dx
-            else:
-                dx = layer(t, dx)
+        return _concat_squash_forward(self, t, x)[0]
 
-        if self.is_recording:
-            self.record.append((t, dx.clone().detach(), x.clone().detach()))
-        return dx
+    def jacobian(self, t, x):
+        """Returns dx and its exact Jacobian wrt x [batch, dim, dim]."""
+        return _concat_squash_forward(self, t, x, jacobian=True)
 
 
 
 class SparseODENet(nn.Module):
-    def __init__(self, dims, conditional_dims, full_adjacency, device, num_layers=4):
+    def __init__(self, dims, conditional_dims, full_adjacency, device, num_layers=4, sparse_mode="auto"):
         super(SparseODENet, self).__init__()
         self.num_squeeze=0
-        layers = [ConcatSquashLinearSparse(dims + conditional_dims + 1, dims, full_adjacency, device)] + [ConcatSquashLinearSparse(dims, dims, full_adjacency, device) for _ in range(num_layers-1)]
+        full_adjacency = Adjacency.coerce(full_adjacency, (dims, dims + conditional_dims))
+        layers = [ConcatSquashLinearSparse(dims + conditional_dims + 1, dims, full_adjacency, device, sparse_mode)] + [ConcatSquashLinearSparse(dims, dims, full_adjacency, device, sparse_mode) for _ in range(num_layers-1)]
         activation_fns = [nn.Tanh() for _ in range(num_layers)]
         self.layers = nn.ModuleList(layers)
         self.activation_fns = nn.ModuleList(activation_fns[:-1])
-        self.record = []
+        self.time_conditioning = diffeq_layers.TimeConditioning(self.layers)
+        self.recorder = TrajectoryRecorder()
         self.is_recording = False
+        self._probes = None
+
+    def before_odeint(self):
+        # called by ODEfunc at the start of every solve, drops the masked
+        # weights, conditioning projections and time gates of the previous solve
+        for layer in self.layers:
+            _clear_cache(layer)
+        self.time_conditioning.clear()
+
+    def jacobian_pattern(self):
+        """Adjacency of the entries of d dx / dx that the masks allow to be nonzero."""
+        dims = self.layers[-1].dim_out
+        masks = [layer._adjacency.crop(layer.dim_out, dims) for layer in self.layers]
+        pattern = masks[0]
+        for mask in masks[1:-1]:
+            pattern = pattern.union(mask.compose(pattern))
+        return masks[-1].compose(pattern) if len(masks) > 1 else pattern
+
+    def coloring_probes(self):
+        """0/1 probes [num_colors, dim], one per color of jacobian_pattern,
+        see divergence_colored. The masks are fixed, so they are built once."""
+        if self._probes is None:
+            colors = torch.from_numpy(self.jacobian_pattern().coloring())
+            self._probes = torch.zeros(int(colors.max()) + 1, len(colors))
+            self._probes[colors, torch.arange(len(colors))] = 1.0
+        return self._probes
+
+    def num_weight_builds(self):
+        """Number of masked weight matrices computed since the last before_odeint."""
+        return sum(layer.weight_builds for layer in self.layers)
 
     def forward(self, t, x):
-        batch_dim = x.shape[0]
-        #dx = torch.zeros(x.shape).to(x)
-        dx = torch.cat([x, self.conditioned, t * torch.ones([batch_dim, 1]).to(x.device)], dim=1)
-        for l, layer in enumerate(self.layers):
-            # if not last layer, use nonlinearity
-            if l < len(self.layers) - 1:
-                acti = layer(t, dx)
-                if l == 0:
-                    dx = self.activation_fns[l](acti)
-                else:
-                    dx = self.activation_fns[l](acti) + dx
-            else:
-                dx = layer(t, dx)
+        return _concat_squash_forward(self, t, x)[0]
 
-        if self.is_recording:
-            self.record.append((t, dx.clone().detach(), x.clone().detach()))
-        return dx
+    def jacobian(self, t, x):
+        """Returns dx and its exact Jacobian wrt x [batch, dim, dim]."""
+        return _concat_squash_forward(self, t, x, jacobian=True)
 
 
 ################################################
@@ -232,6 +411,10 @@ class ODENet(nn.Module):
 
         self.layers = nn.ModuleList(layers)
         self.activation_fns = nn.ModuleList(activation_fns[:-1])
+        self.time_conditioning = diffeq_layers.TimeConditioning(self.layers)
+
+    def before_odeint(self):
+        self.time_conditioning.clear()
 
     def forward(self, t, y):
         dx = torch.cat([y, self.conditioned], dim=1)
@@ -0,0 +1,115 @@
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from flow import create_batch
+
+
+def _seed_worker(seed):
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def _simulate(gmodel, batch_size, repeat_samples, seed, out_queue, stop_event, share_memory):
+    if seed is not None:
+        _seed_worker(seed)
+    while not stop_event.is_set():
+        xs, ys = create_batch(gmodel.sample, batch_size, repeat_samples)
+        if share_memory:
+            xs.share_memory_()
+            ys.share_memory_()
+        # block on the bounded queue, but wake up regularly to notice close()
+        while not stop_event.is_set():
+            try:
+                out_queue.put((xs, ys), timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+
+class BatchPrefetcher:
+    """Simulates (x, y) minibatches from a graphical model in the background.
+
+    Producers fill one bounded queue per worker and batches are consumed
+    round-robin, so simulation of the next batches overlaps with the ODE
+    solves of the current one. With the "process" backend every worker is
+    seeded with seed + worker index and the sequence of batches is
+    deterministic, tensors are passed through shared memory. The models
+    hold lambdas and cannot be pickled, so the processes are always forked
+    and the backend is rejected where fork is unavailable (Windows). The
+    "thread" backend shares the global RNG with the training loop and is
+    therefore only reproducible up to thread scheduling.
+    """
+
+    def __init__(self, gmodel, batch_size, repeat_samples=1, num_workers=1,
+                 queue_size=4, backend="thread", seed=None):
+        assert num_workers > 0
+        assert backend in ("thread", "process")
+        if backend == "process" and "fork" not in mp.get_all_start_methods():
+            raise ValueError("The process backend forks the models into the workers, fork is not "
+                             "available here, use the thread backend")
+        self.gmodel = gmodel
+        self.batch_size = batch_size
+        self.repeat_samples = repeat_samples
+        self.num_workers = num_workers
+        self.backend = backend
+        self.seed = seed
+
+        maxsize = max(1, -(-queue_size // num_workers))
+        if backend == "thread":
+            self._stop = threading.Event()
+            self._queues = [queue.Queue(maxsize) for _ in range(num_workers)]
+        else:
+            self._context = mp.get_context("fork")
+            self._stop = self._context.Event()
+            self._queues = [self._context.Queue(maxsize) for _ in range(num_workers)]
+        self._workers = []
+        self._next_worker = 0
+
+    def start(self):
+        for i, q in enumerate(self._queues):
+            if self.backend == "thread":
+                # threads share the RNG of the main process, seeding them individually is meaningless
+                worker_args = (self.gmodel, self.batch_size, self.repeat_samples,
+                               None, q, self._stop, False)
+                worker = threading.Thread(target=_simulate, args=worker_args, daemon=True)
+            else:
+                worker_seed = None if self.seed is None else self.seed + i
+                worker_args = (self.gmodel, self.batch_size, self.repeat_samples,
+                               worker_seed, q, self._stop, True)
+                worker = self._context.Process(target=_simulate, args=worker_args, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._workers:
+            self.start()
+        q = self._queues[self._next_worker]
+        self._next_worker = (self._next_worker + 1) % self.num_workers
+        while True:
+            try:
+                return q.get(timeout=1.0)
+            except queue.Empty:
+                if not any(w.is_alive() for w in self._workers):
+                    raise RuntimeError("All simulation workers died.")
+
+    def close(self):
+        self._stop.set()
+        for worker in self._workers:
+            worker.join(timeout=5.0)
+        self._workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,106 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class TrajectoryRecorder:
+    """Records (t, dx, x) of the ODE right hand side into a preallocated ring buffer.
+
+    Buffers for capacity evaluations are allocated on the device of the
+    first recorded state and filled in place. An evaluation is only kept if
+    its time differs by at least min_dt from the last kept one, which thins
+    out the stages and rejected steps of adaptive solvers. Once the ring is
+    full the oldest evaluations are overwritten, unless spill is a
+    directory: then the whole ring is appended to raw float32 files there
+    first, so arbitrarily long runs can be recorded with bounded memory.
+    The spilled files are read back memory-mapped.
+
+    A change of the batch shape starts a new recording.
+    """
+
+    def __init__(self, capacity=1000, min_dt=0.0, spill=None):
+        self.capacity = capacity
+        self.min_dt = min_dt
+        self.spill = spill
+        self._t = None
+        self.clear()
+
+    def clear(self):
+        """Drops everything recorded so far, including spilled files."""
+        self._count = 0
+        self._spilled = 0
+        self._last_t = None
+        if self.spill is not None and os.path.exists(self._file("meta.json")):
+            for name in ("meta.json", "t.f32", "dx.f32", "x.f32"):
+                os.remove(self._file(name))
+
+    def _file(self, name):
+        return os.path.join(self.spill, name)
+
+    def _allocate(self, x):
+        self.shape = tuple(x.shape)
+        self._t = x.new_zeros(self.capacity)
+        self._dx = x.new_zeros((self.capacity,) + self.shape)
+        self._x = x.new_zeros((self.capacity,) + self.shape)
+
+    def __len__(self):
+        return self._spilled + min(self._count, self.capacity)
+
+    def record(self, t, dx, x):
+        t_ = float(t)
+        if self._last_t is not None and abs(t_ - self._last_t) < self.min_dt:
+            return
+        if self._t is None or tuple(x.shape) != self.shape:
+            self.clear()
+            self._allocate(x)
+        if self._count == self.capacity and self.spill is not None:
+            self._flush()
+        slot = self._count % self.capacity
+        with torch.no_grad():
+            self._t[slot] = t_
+            self._dx[slot].copy_(dx)
+            self._x[slot].copy_(x)
+        self._count += 1
+        self._last_t = t_
+
+    def _flush(self):
+        # appends the full ring to the spill files
+        os.makedirs(self.spill, exist_ok=True)
+        for name, buffer in (("t", self._t), ("dx", self._dx), ("x", self._x)):
+            with open(self._file(name + ".f32"), "ab") as f:
+                f.write(buffer.detach().cpu().numpy().astype(np.float32).tobytes())
+        self._spilled += self.capacity
+        self._count = 0
+        with open(self._file("meta.json"), "w") as f:
+            json.dump({"count": self._spilled, "shape": list(self.shape)}, f)
+
+    def _ring(self):
+        # buffered evaluations in recording order
+        n = min(self._count, self.capacity)
+        order = torch.arange(self._count - n, self._count) % self.capacity
+        return [b[order.to(b.device)].cpu().numpy() for b in (self._t, self._dx, self._x)]
+
+    def read(self, samples=None, sort=False):
+        """Returns t [N], dx [N, batch, dim] and x [N, batch, dim] as numpy arrays.
+
+        samples selects batch entries, e.g. a few particles to plot, sort
+        orders the evaluations by time instead of by recording order (the
+        reverse solve and the adjoint pass run backwards)."""
+        if self._t is None:
+            return np.zeros([0]), np.zeros([0, 0, 0]), np.zeros([0, 0, 0])
+        parts = []
+        if self._spilled > 0:
+            shape = (self._spilled,) + self.shape
+            parts.append([np.memmap(self._file("t.f32"), dtype=np.float32, mode="r", shape=(self._spilled,)),
+                          np.memmap(self._file("dx.f32"), dtype=np.float32, mode="r", shape=shape),
+                          np.memmap(self._file("x.f32"), dtype=np.float32, mode="r", shape=shape)])
+        parts.append(self._ring())
+        if samples is not None:
+            parts = [[t, dx[:, samples], x[:, samples]] for t, dx, x in parts]
+        t, dx, x = [np.concatenate(arrays) for arrays in zip(*parts)]
+        if sort:
+            order = np.argsort(t, kind="stable")
+            t, dx, x = t[order], dx[order], x[order]
+        return t, dx, x
@@ -0,0 +1,84 @@
+import importlib
+import time
+
+# Built-in graphical models as "module:attribute" entry points plus constructor
+# arguments. Modules are only imported once a model is constructed.
+MODELS = {
+    "gaussian_bn": ("models:GaussianBayesianNetwork", ()),
+    "crazy1d": ("models:Crazy1D", ()),
+    "circle": ("models:CircleModel", ()),
+    "state_space": ("models:StateSpaceModel", ()),
+    "state_space_larger": ("models:StateSpaceModelLarger", ()),
+    "8gaussians": ("models:ToyData", ("8gaussians",)),
+    "rings": ("models:ToyData", ("rings",)),
+    "swissroll": ("models:ToyData", ("swissroll",)),
+    "bigger_graph1": ("models:BiggerGraph1", ()),
+    "bigger_graph2": ("models:BiggerGraph2", ()),
+    "bigger_graph3": ("models:BiggerGraph3", ()),
+    "bigger_graph4": ("models:BiggerGraph4", ()),
+    "bigger_graph5": ("models:BiggerGraph5", ()),
+    "bigger_graph6": ("models:BiggerGraph6", ()),
+    "simple_arith_circuit": ("models:SimpleArithmeticCircuit", ()),
+    "ber_gmm": ("models:BernoulliGMM", ()),
+}
+
+# Entry point group under which installed packages can register models.
+ENTRY_POINT_GROUP = "daphne.models"
+
+# Seconds spent constructing each model, by name.
+construction_times = {}
+
+
+def register(name, entry_point, *args):
+    """Registers a model factory given as "module:attribute" (or a callable)."""
+    MODELS[name] = (entry_point, args)
+
+
+def _load(entry_point):
+    if callable(entry_point):
+        return entry_point
+    module, attr = entry_point.split(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def _installed_entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return {}
+    eps = entry_points()
+    eps = eps.select(group=ENTRY_POINT_GROUP) if hasattr(eps, "select") \
+        else eps.get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep for ep in eps}
+
+
+def resolve(name):
+    """Returns the factory and constructor arguments for a model name."""
+    if name in MODELS:
+        entry_point, args = MODELS[name]
+        return _load(entry_point), args
+    if name.endswith(".json"):
+        # output of `daphne graph`
+        return _load("graph_model:load_graph"), (name,)
+    if name.startswith("synthetic-"):
+        # e.g. synthetic-random-1000-fan_in=3, see synthetic.from_name
+        return _load("synthetic:from_name"), (name,)
+    if name.startswith("autogen"):
+        # output of `daphne python-class`
+        return _load(name + ":FlowModel"), ()
+    installed = _installed_entry_points()
+    if name in installed:
+        return installed[name].load(), ()
+    raise Exception("Model unknown: {}".format(name))
+
+
+def create_model(name):
+    start = time.time()
+    factory, args = resolve(name)
+    gmodel = factory(*args)
+    construction_times[name] = time.time() - start
+    return gmodel
+
+
+def available_models():
+    return sorted(set(MODELS) | set(_installed_entry_points()))
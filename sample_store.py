@@ -0,0 +1,126 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from flow import create_batch
+
+
+class SampleStore:
+    """Memory-mapped on-disk store of simulated (x, y) pairs.
+
+    Latents and observations are kept as two float32 .npy arrays of shape
+    [N, dim_latent] and [N, dim_condition] in a directory keyed by model name,
+    seed and dimensions, fill simulates with that seed so that a store is
+    reproducible and reused by runs of any training seed. The meta.json file is only written once both arrays
+    are complete, so interrupted simulations are not picked up. Pairs produced
+    outside of Python, e.g. by the CUDA export, can be imported with write()
+    as long as they follow the same layout.
+    """
+
+    def __init__(self, root, gmodel_name, seed, dim_latent, dim_condition):
+        self.dim_latent = dim_latent
+        self.dim_condition = dim_condition
+        self.seed = seed
+        self.path = os.path.join(root, "{}_seed{}_{}x{}".format(gmodel_name, seed,
+                                                                 dim_latent, dim_condition))
+        self._xs = None
+        self._ys = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self._file("meta.json"))
+
+    def __len__(self):
+        return self._open()[0].shape[0]
+
+    def _open(self):
+        if self._xs is None:
+            if not self.exists():
+                raise FileNotFoundError("No samples stored at {}".format(self.path))
+            self._xs = np.load(self._file("x.npy"), mmap_mode="r")
+            self._ys = np.load(self._file("y.npy"), mmap_mode="r")
+        return self._xs, self._ys
+
+    def _allocate(self, num_samples):
+        os.makedirs(self.path, exist_ok=True)
+        if self.exists():
+            os.remove(self._file("meta.json"))
+        self._xs, self._ys = None, None
+        xs = np.lib.format.open_memmap(self._file("x.npy"), mode="w+", dtype=np.float32,
+                                       shape=(num_samples, self.dim_latent))
+        ys = np.lib.format.open_memmap(self._file("y.npy"), mode="w+", dtype=np.float32,
+                                       shape=(num_samples, self.dim_condition))
+        return xs, ys
+
+    def _finalize(self, xs, ys, source):
+        num_samples = xs.shape[0]
+        xs.flush()
+        ys.flush()
+        with open(self._file("meta.json"), "w") as f:
+            json.dump({"num_samples": num_samples,
+                       "dim_latent": self.dim_latent,
+                       "dim_condition": self.dim_condition,
+                       "source": source}, f)
+
+    def fill(self, gmodel, num_samples, chunk_size=10000):
+        """Simulates num_samples pairs from gmodel and writes them chunk by chunk.
+
+        The torch and numpy generators are forked and seeded with the seed
+        of the store, the random stream of the caller is left unchanged."""
+        assert gmodel.dim_latent == self.dim_latent
+        assert gmodel.dim_condition == self.dim_condition
+        xs, ys = self._allocate(num_samples)
+        np_state = np.random.get_state()
+        try:
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(self.seed)
+                np.random.seed(self.seed)
+                for start in range(0, num_samples, chunk_size):
+                    n = min(chunk_size, num_samples - start)
+                    x, y = create_batch(gmodel.sample, n)
+                    xs[start:start + n] = x.numpy()
+                    ys[start:start + n] = y.numpy()
+        finally:
+            np.random.set_state(np_state)
+        self._finalize(xs, ys, "simulated")
+        return self
+
+    def write(self, x, y, source="external"):
+        """Stores externally produced pairs, x: [N, dim_latent], y: [N, dim_condition]."""
+        x = np.asarray(x, dtype=np.float32)
+        y = np.asarray(y, dtype=np.float32)
+        assert x.shape[0] == y.shape[0]
+        assert x.shape[1:] == (self.dim_latent,)
+        assert y.shape[1:] == (self.dim_condition,)
+        xs, ys = self._allocate(x.shape[0])
+        xs[:] = x
+        ys[:] = y
+        self._finalize(xs, ys, source)
+        return self
+
+    def _take(self, idx):
+        xs, ys = self._open()
+        idx = np.sort(idx)
+        return torch.from_numpy(xs[idx]), torch.from_numpy(ys[idx])
+
+    def minibatch(self, batch_size, rng=None):
+        """Draws a minibatch by random index, without replacement within the
+        batch. rng is a numpy Generator, by default a fresh one."""
+        rng = np.random.default_rng() if rng is None else rng
+        return self._take(rng.choice(len(self), batch_size, replace=False))
+
+    def batches(self, batch_size, seed=None):
+        """Yields minibatches of a new random permutation of the pairs per
+        epoch, so that no pair repeats within a batch or an epoch. The last
+        len % batch_size pairs of a permutation are skipped."""
+        n = len(self)
+        assert batch_size <= n, "Batch size {} exceeds the {} stored pairs".format(batch_size, n)
+        rng = np.random.default_rng(seed)
+        while True:
+            order = rng.permutation(n)
+            for start in range(0, n - batch_size + 1, batch_size):
+                yield self._take(order[start:start + batch_size])
@@ -8,7 +8,7 @@
             [backtick :refer [template]]
             [clojure.pprint :refer [pprint]]
             [clojure.core.match :refer [match]]
-            [clojure.walk :refer [postwalk]]
+            [clojure.walk :refer [postwalk postwalk-replace]]
             [clojure.string :as str]
             [clojure.java.shell :as sh]))
 
@@ -94,6 +94,14 @@
     `(~'.sample ~(second n))
     n))
 
+(defn- batch-sample
+  "Draws n samples at once by expanding the batch shape of the distribution."
+  [n]
+  (if (and (seq? n)
+           (= (first n) '.sample))
+    `(~'.sample (~'.expand ~(second n) [~'n]))
+    n))
+
 (defn gensym-comp [a b]
   (let [[_ a-index] (str/split (name a) #"_")
         [_ b-index] (str/split (name b) #"_")
@@ -128,6 +136,46 @@
                                 #_(vec (sort (map first (filter #(re-find #"observe*" (name (first %)))
                                                                instructions)))))])))))))
 
+(defn- data-dependent-if?
+  "Is n an if expression whose condition reads a sampled or observed value?"
+  [n]
+  (and (seq? n)
+       (= (first n) 'if)
+       (boolean (some gensym->cursor (filter symbol? (flatten (list (second n))))))))
+
+(defn batchable?
+  "The batched sampler evaluates every link function once for the whole
+  batch, which is only possible without branching on random values."
+  [code]
+  (binding [*gensyms* (atom (range))
+            daphne.gensym/*my-gensym* combined-gensym]
+    (not-any? data-dependent-if? (tree-seq coll? seq (code->hy-instructions code)))))
+
+(defn create-batch-sampler
+  "Creates a batched sampling routine for n draws from the joint distribution."
+  [code]
+  (binding [*gensyms* (atom (range))
+            daphne.gensym/*my-gensym* combined-gensym]
+    (let [instructions (code->hy-instructions code)]
+      (postwalk
+       (comp batch-sample observe->sample)
+       `(do ~@(concat
+               (map (fn [[sym exp]] `(~'setv ~sym ~exp)) instructions)
+               `([;; prior
+                  (torch.stack ~(->> instructions
+                                     (map first)
+                                     (filter #(re-find #"sample*" (name %)))
+                                     (sort gensym-comp)
+                                     vec)
+                               1)
+                  ;; likelihood
+                  (torch.stack ~(->> instructions
+                                     (map first)
+                                     (filter #(re-find #"observe*" (name %)))
+                                     (sort gensym-comp)
+                                     vec)
+                               1)])))))))
+
 (defn symbol->slice
   "Extracts the index of a sample or observe expression and generates a slice
   based access into the corresponding tensor."
@@ -166,6 +214,55 @@
 (defn create-likelihood [code dim-prior]
   (create-log-prob code #"observe*" 'log_likeli dim-prior))
 
+(defn- subexpressions [exp]
+  (filter seq? (tree-seq seq? rest exp)))
+
+(defn eliminate-common-subexpressions
+  "Binds every subexpression that occurs more than once in exps to a symbol.
+  Returns the bindings in evaluation order, inner expressions first, and the
+  rewritten expressions."
+  [exps]
+  (let [shared (->> exps
+                    (mapcat subexpressions)
+                    frequencies
+                    (filter (fn [[_ n]] (> n 1)))
+                    (map first)
+                    (sort-by (comp count subexpressions)))
+        [bindings smap] (reduce (fn [[bindings smap] exp]
+                                  (let [exp (postwalk-replace smap exp)]
+                                    (if (contains? smap exp)
+                                      [bindings smap]
+                                      (let [sym (symbol (str "cse_" (count bindings)))]
+                                        [(conj bindings [sym exp]) (assoc smap exp sym)]))))
+                                [[] {}]
+                                shared)]
+    [bindings (map (partial postwalk-replace smap) exps)]))
+
+(defn create-log-joint
+  "Computes log prior and log likelihood in one pass where link expressions
+  and distribution objects shared between nodes are only built once."
+  [code dim-prior]
+  (binding [*gensyms* (atom (range))
+            *offset* dim-prior
+            daphne.gensym/*my-gensym* combined-gensym]
+    (let [instructions (code->hy-instructions code)
+          log-probs (fn [sym-regex]
+                      (->> instructions
+                           (filter #(re-find sym-regex (name (first %))))
+                           (map (fn [[csym exp]] `(.log_prob ~(second exp) ~csym)))
+                           (postwalk symbol->slice)))
+          prior (log-probs #"sample*")
+          likelihood (log-probs #"observe*")
+          [bindings exps] (eliminate-common-subexpressions (concat prior likelihood))
+          [prior likelihood] (split-at (count prior) exps)]
+      `(do ~@(concat
+              (map (fn [[sym exp]] `(~'setv ~sym ~exp)) bindings)
+              [`(~'setv ~'log_prior ~'(torch.zeros (get sample.shape 0)))]
+              (map (fn [exp] `(~'+= ~'log_prior ~exp)) prior)
+              [`(~'setv ~'log_likeli ~'(torch.zeros (get sample.shape 0)))]
+              (map (fn [exp] `(~'+= ~'log_likeli ~exp)) likelihood)
+              ['[log_prior log_likeli]])))))
+
 (defn create-rand-adjacency [target-count dim-latent dim-condition]
   (loop [prob 0.5
          i 0]
@@ -224,9 +321,22 @@
        ;;  rand_adjacency ~(vec rand-adjacency)]
 
        ;; use Giry Monad interface (?)
-       ;; Void -> [Tensor[dim_latent], Tensor[dim_condition]]
-       (defn sample [self]
-         ~(create-sampler code))
+       ;; branching on random values is evaluated in Python, such programs
+       ;; only get the scalar sampler and are batched by flow.create_batch
+       ~@(if (batchable? code)
+           (template
+            [;; Int -> [Tensor[n, dim_latent], Tensor[n, dim_condition]]
+             (defn sample_batch [self n]
+               ~(create-batch-sampler code))
+
+             ;; Void -> [Tensor[dim_latent], Tensor[dim_condition]]
+             (defn sample [self]
+               (setv batch (.sample_batch self 1))
+               [(get batch 0 0) (get batch 1 0)])])
+           (template
+            [;; Void -> [Tensor[dim_latent], Tensor[dim_condition]]
+             (defn sample [self]
+               ~(create-sampler code))]))
 
        ;; Tensor[dim_latent], Tensor[dim_condition] -> LogProb
        (defn log_likelihood [self sample observe]
@@ -234,7 +344,11 @@
 
        ;; Tensor[dim_latent] -> LogProb
        (defn log_prior [self sample]
-         ~(create-prior code)))))) 
+         ~(create-prior code))
+
+       ;; Tensor[dim_latent], Tensor[dim_condition] -> [LogProb, LogProb]
+       (defn log_joint [self sample observe]
+         ~(create-log-joint code dim-latent)))))) 
 
 (def python-imports
   '((import torch)
@@ -252,9 +366,7 @@
                            (println)
                            (pprint
                             '(defn safe-tanh [x]
-                               (if (isinstance x float)
-                                 (math.tanh x)
-                                 (torch.tanh x))))
+                               (torch.tanh (torch.as_tensor x))))
                            (println)
                            (pprint hy-code))
         python-output (->> prefixed-hy-code
@@ -0,0 +1,153 @@
+import math
+import re
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from adjacency import Adjacency
+from density import FAMILIES
+
+NONLINEARITIES = {
+    "linear": lambda a: a,
+    "tanh": torch.tanh,
+    "sin": torch.sin,
+    "softplus": F.softplus,
+}
+
+TOPOLOGIES = ("chain", "tree", "grid", "random")
+
+
+def _parents(topology, num_latent, fan_in, rng):
+    """Parent lists of latents 0..num_latent-1, parents always precede their child."""
+    if topology == "chain":
+        return [[]] + [[i - 1] for i in range(1, num_latent)]
+    if topology == "tree":
+        # complete tree with branching factor fan_in
+        return [[]] + [[(i - 1) // fan_in] for i in range(1, num_latent)]
+    if topology == "grid":
+        side = int(math.ceil(math.sqrt(num_latent)))
+        return [([i - side] if i >= side else []) + ([i - 1] if i % side else [])
+                for i in range(num_latent)]
+    if topology == "random":
+        return [[]] + [sorted(rng.choice(i, min(fan_in, i), replace=False).tolist())
+                       for i in range(1, num_latent)]
+    raise ValueError("Unknown topology: {}".format(topology))
+
+
+class SyntheticModel:
+    """Parametric graphical model for scaling experiments.
+
+    Latent i is Normal(f(sum_j w_ij x_j), noise) over its parents j, roots
+    are Normal(0, 1). A fraction obs_fraction of the latents is observed
+    with Normal(x_i, obs_noise). Structure and weights only depend on seed,
+    so a name in the registry always refers to the same model.
+
+    Sampling runs level by level of the DAG and the densities are evaluated
+    for all latents at once with padded parent index tensors.
+    faithful_adjacency is the NaMI inverse of the forward structure, see
+    Adjacency.faithful_inverse.
+    """
+
+    def __init__(self, topology="random", num_latent=100, fan_in=2, nonlinearity="tanh",
+                 obs_fraction=0.5, noise=0.5, obs_noise=0.1, seed=0):
+        rng = np.random.RandomState(seed)
+        self.topology = topology
+        self.f = NONLINEARITIES[nonlinearity]
+        self.noise = noise
+        self.obs_noise = obs_noise
+        self.dim_latent = num_latent
+
+        parents = _parents(topology, num_latent, fan_in, rng)
+        width = max(len(p) for p in parents) if num_latent > 0 else 0
+        index = np.zeros([num_latent, max(width, 1)], dtype=np.int64)
+        weight = np.zeros([num_latent, max(width, 1)], dtype=np.float32)
+        for i, p in enumerate(parents):
+            index[i, :len(p)] = p
+            weight[i, :len(p)] = rng.choice([-1.0, 1.0], len(p)) * rng.uniform(0.5, 1.0, len(p)) \
+                / math.sqrt(max(len(p), 1))
+        self.parent_index = torch.from_numpy(index)
+        self.parent_weight = torch.from_numpy(weight)
+        self.has_parents = torch.tensor([1.0 if p else 0.0 for p in parents])
+        self.scale = torch.tensor([noise if p else 1.0 for p in parents])
+
+        num_obs = max(1, int(round(obs_fraction * num_latent)))
+        self.observed = torch.from_numpy(np.sort(rng.choice(num_latent, num_obs, replace=False)))
+        self.dim_condition = num_obs
+
+        # ancestral sampling order, nodes of the same depth are drawn together
+        depth = np.zeros(num_latent, dtype=np.int64)
+        for i, p in enumerate(parents):
+            depth[i] = 1 + max([depth[j] for j in p]) if p else 0
+        self.levels = [torch.from_numpy(np.nonzero(depth == d)[0]) for d in range(depth.max() + 1)]
+
+        self.faithful_adjacency = self._faithful(parents)
+        self.rand_adjacency = Adjacency.random(self.faithful_adjacency.shape,
+                                               len(self.faithful_adjacency))
+
+    def _faithful(self, parents):
+        L = self.dim_latent
+        child = np.repeat(np.arange(L), [len(p) for p in parents])
+        parent = np.concatenate([np.asarray(p, dtype=np.int64) for p in parents]) \
+            if len(child) else np.zeros([0], dtype=np.int64)
+        observed = self.observed.numpy()
+        num_vars = L + len(observed)
+        forward = Adjacency(np.concatenate([parent, observed]),
+                            np.concatenate([child, L + np.arange(len(observed))]), (num_vars, num_vars))
+        return forward.faithful_inverse(L)
+
+    def _loc(self, x, nodes=None):
+        index, weight, has_parents = self.parent_index, self.parent_weight, self.has_parents
+        if nodes is not None:
+            index, weight, has_parents = index[nodes], weight[nodes], has_parents[nodes]
+        # roots are centered, also for nonlinearities with f(0) != 0
+        return self.f((x[:, index] * weight.to(x)).sum(dim=2)) * has_parents.to(x)
+
+    def sample_batch(self, n):
+        x = torch.zeros([n, self.dim_latent])
+        for nodes in self.levels:
+            x[:, nodes] = self._loc(x, nodes) + self.scale[nodes] * torch.randn([n, len(nodes)])
+        y = x[:, self.observed] + self.obs_noise * torch.randn([n, self.dim_condition])
+        return x, y
+
+    def sample(self):
+        x, y = self.sample_batch(1)
+        return x[0], y[0]
+
+    def log_prior(self, x):
+        return FAMILIES["normal"](x, self._loc(x), self.scale.to(x)).sum(dim=1)
+
+    def log_likelihood(self, x, y):
+        scale = torch.full_like(y, self.obs_noise)
+        return FAMILIES["normal"](y, x[:, self.observed], scale).sum(dim=1)
+
+    def log_joint(self, x, y):
+        return self.log_prior(x), self.log_likelihood(x, y)
+
+
+def _parse(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+# options of from_name that are standard deviations
+SCALE_OPTIONS = ("noise", "obs_noise")
+
+
+def from_name(name):
+    """Builds a model from "synthetic-<topology>-<num_latent>[-key=value...]",
+    e.g. "synthetic-random-1000-fan_in=3-nonlinearity=linear". Options are
+    separated by a "-" in front of "key=", so values may be negative."""
+    head, *options = re.split(r"-(?=[A-Za-z_]\w*=)", name)
+    _, topology, num_latent = head.split("-")
+    assert topology in TOPOLOGIES, "Unknown topology: {}".format(topology)
+    kwargs = {k: _parse(v) for k, v in (option.split("=", 1) for option in options)}
+    for scale in SCALE_OPTIONS:
+        if scale in kwargs and not (isinstance(kwargs[scale], (int, float)) and kwargs[scale] > 0):
+            raise ValueError("{} is a standard deviation and has to be positive, not {}".format(
+                scale, kwargs[scale]))
+    return SyntheticModel(topology, int(num_latent), **kwargs)
@@ -68,3 +68,45 @@
                                       (flip 0.9)
                                       nil)))
                                 true)]])))))
+
+
+(deftest eliminate-common-subexpressions-test
+  (testing "Shared subexpressions are bound once, inner ones first."
+    (is (= '[[[cse_0 (+ a b)]
+              [cse_1 (Normal cse_0 1.0)]]
+             ((.log_prob cse_1 x)
+              (.log_prob cse_1 y)
+              (.log_prob (Normal (* cse_0 2.0) 1.0) z))]
+           (let [[bindings exps]
+                 (eliminate-common-subexpressions
+                  '((.log_prob (Normal (+ a b) 1.0) x)
+                    (.log_prob (Normal (+ a b) 1.0) y)
+                    (.log_prob (Normal (* (+ a b) 2.0) 1.0) z)))]
+             [bindings exps])))))
+
+
+(deftest batchable-test
+  (testing "Only programs without branching on random values get a batched sampler."
+    (is (batchable? '((let [x (sample (normal 0.0 1.0))]
+                        (observe (normal (tanh x) 1.0) 2.0)
+                        x))))
+    (is (not (batchable? '((let [x (sample (normal 0.0 1.0))
+                                 y (sample (normal (if (> x 0.0) 1.0 -1.0) 1.0))]
+                             (observe (normal y 1.0) 2.0)
+                             (vector x y))))))))
+
+
+(deftest sampler-test
+  (testing "The batched sampler expands the distributions, the scalar one does not."
+    (let [code '((let [x (sample (normal 0.0 1.0))]
+                   (observe (normal x 1.0) 2.0)
+                   x))
+          expands? (fn [exp] (some #{'.expand} (flatten exp)))]
+      (is (expands? (create-batch-sampler code)))
+      (is (not (expands? (create-sampler code)))))))
+
+
+(deftest safe-tanh-test
+  (testing "tanh is coerced to tensors, constants can be python floats."
+    (is (= '[[sample_0 (.sample (Normal (safe_tanh 0.5) 1.0))]]
+           (expressions->hy '[[sample_0 (sample* (normal (tanh 0.5) 1.0))]])))))
@@ -0,0 +1,41 @@
+import os
+import sys
+from types import SimpleNamespace
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)))
+
+# flow selects the matplotlib backend, it has to be imported before nets
+import flow  # noqa: E402
+import pytest  # noqa: E402
+import torch  # noqa: E402
+
+from nets import AdaptedODENet, SparseODENet  # noqa: E402
+from registry import create_model  # noqa: E402
+
+
+def log_nothing(name, scalar, step=None):
+    pass
+
+
+@pytest.fixture
+def flow_args():
+    """Factory of the args namespace of main.init for small training runs."""
+    def make(gmodel_name="gaussian_bn", batch_size=8, repeat_samples=1,
+             flow_connectivity="fully_connected", atol=1e-4, rtol=1e-4, **cnf_kwargs):
+        torch.manual_seed(0)
+        gmodel = create_model(gmodel_name)
+        args = SimpleNamespace(gmodel=gmodel, batch_size=batch_size, repeat_samples=repeat_samples,
+                               device=torch.device("cpu"),
+                               integration_times=torch.tensor([0.0, 1.0]),
+                               xshift=torch.zeros(gmodel.dim_latent), xscale=torch.ones(gmodel.dim_latent),
+                               yshift=torch.zeros(gmodel.dim_condition), yscale=torch.ones(gmodel.dim_condition))
+        if flow_connectivity == "fully_connected":
+            args.diffeq = AdaptedODENet(gmodel.dim_latent, gmodel.dim_condition)
+        else:
+            args.diffeq = SparseODENet(gmodel.dim_latent, gmodel.dim_condition,
+                                       gmodel.faithful_adjacency, args.device)
+        settings = dict(atol=atol, rtol=rtol, test_atol=atol, test_rtol=rtol)
+        args.cnf = flow.create_cnf(args.diffeq, solver_settings=settings, **cnf_kwargs)
+        return args
+    return make
@@ -0,0 +1,43 @@
+import pytest
+
+from adjacency import Adjacency
+from graph_model import GraphModel
+from registry import create_model
+
+GRAPH = {"V": ["sample1", "sample2", "observe3"],
+         "A": {"sample1": ["sample2"], "sample2": ["observe3"]},
+         "P": {"sample1": ["sample*", ["normal", 0, 1]],
+               "sample2": ["sample*", ["normal", "sample1", 1]],
+               "observe3": ["observe*", ["normal", "sample2", 1], 2.0]},
+         "Y": {"observe3": 2.0}}
+
+
+def test_faithful_inverse_chain():
+    # x0 -> x1 -> x2 -> x3, x_i -> y_i
+    forward = Adjacency.from_pairs([[0, 1], [1, 2], [2, 3]] + [[i, 4 + i] for i in range(4)], (8, 8))
+    inverse = forward.faithful_inverse(4)
+    assert inverse.shape == (4, 8)
+    # eliminated in order, x_i depends on x_{i+1} and the observations up to y_i
+    assert inverse.pairs() == [[0, 0], [0, 1], [0, 4],
+                               [1, 1], [1, 2], [1, 4], [1, 5],
+                               [2, 2], [2, 3], [2, 4], [2, 5], [2, 6],
+                               [3, 3], [3, 4], [3, 5], [3, 6], [3, 7]]
+
+
+def test_faithful_inverse_matches_gaussian_bn():
+    forward = Adjacency.from_pairs([[0, 1], [0, 2], [1, 3], [1, 4], [2, 5], [2, 6]]
+                                   + [[3 + i // 2, 7 + i] for i in range(8)], (15, 15))
+    # the hand-written inverse is NaMI up to ties in the elimination order
+    assert len(forward.faithful_inverse(7)) == len(create_model("gaussian_bn").faithful_adjacency)
+
+
+def test_faithful_inverse_cycle():
+    with pytest.raises(ValueError):
+        Adjacency.from_pairs([[0, 1], [1, 0]], (2, 2)).faithful_inverse(2)
+
+
+def test_graph_model_adjacencies():
+    model = GraphModel(GRAPH)
+    assert model.faithful_adjacency.pairs() == [[0, 0], [0, 1], [1, 1], [1, 2]]
+    assert model.rand_adjacency.shape == model.faithful_adjacency.shape == (2, 3)
+    assert len(model.rand_adjacency) == len(model.faithful_adjacency)
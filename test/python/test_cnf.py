@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from flow import create_batch, create_cnf
+from nets import AdaptedODENet
+from registry import create_model
+
+
+def solve_gradients(backprop_mode, tol, seed=0):
+    """Parameter gradients of one training solve in double precision, the
+    end time gets none as the integration times are not differentiated."""
+    torch.manual_seed(seed)
+    gmodel = create_model("state_space")
+    diffeq = AdaptedODENet(gmodel.dim_latent, gmodel.dim_condition).double()
+    x, y = create_batch(gmodel.sample, 4)
+    diffeq.conditioned = y.double()
+    cnf = create_cnf(diffeq, solver_settings=dict(atol=tol, rtol=tol), backprop_mode=backprop_mode).double()
+    cnf.train()
+    z, delta_logp = cnf(x.double(), torch.zeros(4, 1, dtype=torch.float64))
+    ((z ** 2).sum() + delta_logp.sum()).backward()
+    return [p.grad for p in cnf.parameters() if p is not cnf.sqrt_end_time]
+
+
+@pytest.fixture(scope="module")
+def adjoint_gradients():
+    return solve_gradients("adjoint", 1e-10)
+
+
+def test_direct_matches_adjoint(adjoint_gradients):
+    for direct, adjoint in zip(solve_gradients("direct", 1e-10), adjoint_gradients):
+        assert torch.allclose(direct, adjoint, rtol=1e-6, atol=1e-6)
+
+
+def test_checkpoint_matches_adjoint(adjoint_gradients):
+    for checkpointed, adjoint in zip(solve_gradients("checkpoint", 1e-10), adjoint_gradients):
+        assert torch.allclose(checkpointed, adjoint, rtol=1e-6, atol=1e-6)
+
+
+def test_checkpoint_matches_direct():
+    # same trajectory, so the same gradients up to rounding
+    for checkpointed, direct in zip(solve_gradients("checkpoint", 1e-5), solve_gradients("direct", 1e-5)):
+        assert torch.allclose(checkpointed, direct, rtol=1e-10, atol=1e-12)
+
+
+def test_colored_divergence_needs_sparsity():
+    gmodel = create_model("state_space")
+    with pytest.raises(ValueError, match="Jacobian sparsity"):
+        create_cnf(AdaptedODENet(gmodel.dim_latent, gmodel.dim_condition), divergence_fn="colored")
+
+
+def test_checkpoint_needs_dopri5():
+    gmodel = create_model("state_space")
+    diffeq = AdaptedODENet(gmodel.dim_latent, gmodel.dim_condition)
+    with pytest.raises(ValueError, match="Checkpointed backprop supports dopri5, not rk4"):
+        create_cnf(diffeq, solver_settings=dict(solver="rk4"), backprop_mode="checkpoint")
+    # the test solver does not backpropagate
+    create_cnf(diffeq, solver_settings=dict(test_solver="rk4"), backprop_mode="checkpoint")
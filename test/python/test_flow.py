@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+import torch
+
+from conftest import log_nothing
+from flow import compute_loss, streaming_statistics, training_loss
+from registry import create_model
+from lib.layers.wrappers.cnf_regularization import l2_regularzation_fn, directional_l2_regularization_fn
+
+LOSS_CHOICES = ["forward", "backward", "sym", "sym_reg", "forw_reg", "reg_only"]
+
+
+def train_steps(args, loss_choice, steps=2):
+    optimizer = torch.optim.Adam(args.cnf.parameters(), lr=1e-3)
+    for _ in range(steps):
+        optimizer.zero_grad()
+        res = compute_loss(args, log_nothing)
+        loss = training_loss(res, loss_choice)
+        loss.backward()
+        assert torch.isfinite(loss)
+        for p in args.cnf.parameters():
+            assert p.grad is None or torch.isfinite(p.grad).all()
+        optimizer.step()
+    return res
+
+
+@pytest.mark.parametrize("loss_choice", LOSS_CHOICES)
+def test_repeat_samples(flow_args, loss_choice):
+    args = flow_args("state_space", batch_size=6, repeat_samples=3,
+                     regularization_fns=(l2_regularzation_fn, directional_l2_regularization_fn))
+    res = train_steps(args, loss_choice)
+    assert res.forward_kl.shape == res.reverse_kl.shape == torch.Size([])
+
+
+def test_unknown_loss_choice(flow_args):
+    args = flow_args()
+    res = compute_loss(args, log_nothing)
+    with pytest.raises(Exception, match="Loss choice unknown"):
+        training_loss(res, "nope")
+
+
+def test_sym_auto_backprop(flow_args):
+    # no solve to estimate the graph from in the first step, then everything fits
+    args = flow_args("state_space", backprop_mode="auto", memory_budget=2 ** 40)
+    modes = []
+
+    def log_modes(name, scalar, step=None):
+        if name.endswith("direct_backprop"):
+            modes.append(scalar)
+
+    optimizer = torch.optim.Adam(args.cnf.parameters(), lr=1e-3)
+    for _ in range(3):
+        optimizer.zero_grad()
+        loss = training_loss(compute_loss(args, log_modes), "sym")
+        loss.backward()
+        assert torch.isfinite(loss)
+        optimizer.step()
+    assert modes == [0.0, 0.0, 1.0, 1.0, 1.0, 1.0]
+
+
+def test_budget_covers_both_solves(flow_args):
+    args = flow_args("state_space", backprop_mode="auto", memory_budget=2 ** 40)
+    res = compute_loss(args, log_nothing)
+    training_loss(res, "sym").backward()
+    x0 = torch.randn(args.batch_size, args.gmodel.dim_latent)
+    y = args.gmodel.sample_batch(args.batch_size)[1]
+    one_solve = args.cnf._expected_nfe * args.cnf.activation_bytes(x0, conditioned=y)
+    args.cnf.memory_budget = 1.5 * one_solve
+    assert args.cnf.plan_backprop_mode((x0, y)) == "direct"
+    assert args.cnf.plan_backprop_mode((x0, y), (x0, y)) == "adjoint"
+
+
+def test_forward_solve_on_distinct_pairs(flow_args):
+    args = flow_args("state_space", batch_size=4, repeat_samples=3)
+    rows = []
+    solve = args.cnf.forward
+
+    def record_rows(z, *args_, **kwargs):
+        rows.append((z.shape[0], kwargs["conditioned"].shape[0]))
+        return solve(z, *args_, **kwargs)
+
+    args.cnf.forward = record_rows
+    training_loss(compute_loss(args, log_nothing), "sym").backward()
+    # reverse solve on K flow samples per pair, forward solve on the pairs
+    assert rows == [(12, 12), (4, 4)]
+
+
+def test_adjoint_keeps_conditioning_of_its_solve(flow_args):
+    args = flow_args("state_space", batch_size=4)
+    x, y = args.gmodel.sample_batch(4)
+    params = list(args.diffeq.parameters())
+
+    def reverse_gradients(solve_in_between):
+        torch.manual_seed(1)
+        z, delta_logp = args.cnf(torch.randn(4, x.shape[1]), torch.zeros(4, 1), conditioned=y)
+        if solve_in_between:
+            # another conditioning and other probes before the adjoint pass
+            args.cnf(torch.randn(2, x.shape[1]), torch.zeros(2, 1), conditioned=y[:2] + 1)
+        return torch.autograd.grad((z ** 2).sum() + delta_logp.sum(), params)
+
+    for alone, after in zip(reverse_gradients(False), reverse_gradients(True)):
+        assert torch.allclose(alone, after)
+
+
+def test_statistics_leave_random_stream(tmp_path):
+    gmodel = create_model("state_space")
+    cache_path = str(tmp_path / "stats.th")
+    draws = []
+    for _ in range(2):
+        # the first pass simulates and writes the cache, the second loads it
+        torch.manual_seed(0)
+        np.random.seed(0)
+        stats = streaming_statistics(gmodel.sample, 500, chunk_size=100, cache_path=cache_path)
+        draws.append((torch.rand(3), np.random.rand(3), stats))
+    assert torch.equal(draws[0][0], draws[1][0])
+    assert np.array_equal(draws[0][1], draws[1][1])
+    for a, b in zip(draws[0][2], draws[1][2]):
+        assert torch.equal(a, b)
+    # the statistics depend on their own seed only
+    torch.manual_seed(1)
+    for a, b in zip(streaming_statistics(gmodel.sample, 500, chunk_size=100), draws[0][2]):
+        assert torch.equal(a, b)
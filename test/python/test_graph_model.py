@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from graph_model import GraphModel
+
+# the example of the README, with a positive scale for sample5
+README_GRAPH = [{},
+                {"V": ["sample5", "sample0", "observe6", "observe7", "sample4", "sample2", "sample1", "sample3"],
+                 "A": {"sample0": ["sample2", "sample3"],
+                       "sample1": ["sample2", "sample3"],
+                       "sample4": ["sample5"],
+                       "sample3": ["sample5", "observe6"],
+                       "sample5": ["observe7"]},
+                 "P": {"sample0": ["sample*", ["laplace", 20.0, 2.0]],
+                       "sample1": ["sample*", ["laplace", 10.0, 2.0]],
+                       "sample2": ["sample*", ["normal", ["+", "sample0", "sample1"], 0.1]],
+                       "sample3": ["sample*", ["normal", ["*", "sample0", "sample1"], 0.1]],
+                       "sample4": ["sample*", ["normal", 7.0, 2.0]],
+                       "sample5": ["sample*", ["normal", "sample3", ["exp", ["*", 0.1, "sample4"]]]],
+                       "observe6": ["observe*", ["normal", ["+", "sample3"], 0.1], 0.2],
+                       "observe7": ["observe*", ["normal", "sample5", 0.1], -3.5]},
+                 "Y": {"observe6": 0.2, "observe7": -3.5}},
+                ["sample0", "sample1", "sample2", "sample3", "sample4", "sample5"]]
+
+# (if (> x 0) (observe (normal x 1) 2.0)) as emitted by the graph compiler
+CONDITIONAL_GRAPH = {"V": ["sample1", "observe2"],
+                     "A": {},
+                     "P": {"sample1": ["sample*", ["normal", 0, 1]],
+                           "observe2": ["if", [">", "sample1", 0], ["observe*", ["normal", "sample1", 1], 2.0], 1]},
+                     "Y": {"observe2": 2.0}}
+
+
+def test_sample_batch():
+    torch.manual_seed(0)
+    model = GraphModel(README_GRAPH)
+    x, y = model.sample_batch(2000)
+    assert x.shape == (2000, 6) and y.shape == (2000, 2)
+    # sample2 ~ N(sample0 + sample1, 0.1) and observe6 ~ N(sample3, 0.1)
+    assert (x[:, 2] - x[:, 0] - x[:, 1]).std() == pytest.approx(0.1, rel=0.1)
+    assert (y[:, 0] - x[:, 3]).std() == pytest.approx(0.1, rel=0.1)
+    assert x[:, 4].mean() == pytest.approx(7.0, abs=0.2)
+
+
+def test_density_matches_per_vertex_path():
+    torch.manual_seed(0)
+    model = GraphModel(README_GRAPH)
+    assert model.density is not None
+    x, y = model.sample_batch(10)
+    log_prior, log_likelihood = model.density(x, y)
+    assert torch.allclose(log_prior, model.log_prior(x), atol=1e-4)
+    assert torch.allclose(log_likelihood, model.log_likelihood(x, y), atol=1e-4)
+
+
+def test_log_prob_follows_input_dtype():
+    model = GraphModel(README_GRAPH)
+    x, y = model.sample_batch(4)
+    assert model.log_prior(x.double()).dtype == torch.float64
+
+
+def test_conditional_observe():
+    model = GraphModel(CONDITIONAL_GRAPH)
+    assert model.density is None
+    # the condition makes sample1 a parent of the observe
+    assert model.adjacency.pairs() == [[0, 1]]
+    x, y = torch.tensor([[-1.0], [0.5]]), torch.tensor([[2.0], [2.0]])
+    expected = torch.stack([torch.tensor(0.0), torch.distributions.Normal(0.5, 1).log_prob(torch.tensor(2.0))])
+    assert torch.allclose(model.log_likelihood(x, y), expected)
+
+
+def test_unsupported_graphs():
+    graph = dict(CONDITIONAL_GRAPH, P=dict(CONDITIONAL_GRAPH["P"], observe2=[
+        "if", [">", "sample1", 0], ["observe*", ["normal", 0, 1], 2.0], ["observe*", ["normal", 1, 1], 2.0]]))
+    with pytest.raises(ValueError, match="Unsupported conditional"):
+        GraphModel(graph)
+    with pytest.raises(ValueError, match="not a scalar"):
+        GraphModel(dict(CONDITIONAL_GRAPH, Y={"observe2": [2.0, 1.0]}))
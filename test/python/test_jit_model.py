@@ -0,0 +1,25 @@
+import pytest
+import torch
+
+from jit_model import ScriptedModel, check_parity
+from registry import MODELS, create_model
+
+# ToyData samples through numpy, which tracing turns into constants
+NUMPY_SAMPLERS = ("8gaussians", "rings", "swissroll")
+
+pytestmark = pytest.mark.filterwarnings("ignore::torch.jit.TracerWarning")
+
+
+@pytest.mark.parametrize("name", sorted(set(MODELS) - set(NUMPY_SAMPLERS)))
+def test_parity(name):
+    torch.manual_seed(0)
+    deviations = check_parity(create_model(name), n=16)
+    assert set(deviations) == {"log_prior", "log_likelihood", "log_joint", "grad_log_joint", "sample_batch"}
+
+
+def test_other_batch_sizes_are_eager():
+    torch.manual_seed(0)
+    gmodel = create_model("state_space")
+    scripted = ScriptedModel(gmodel, 8)
+    x, y = scripted.sample_batch(3)
+    assert x.shape == (3, gmodel.dim_latent) and y.shape == (3, gmodel.dim_condition)
@@ -0,0 +1,39 @@
+import pytest
+import torch
+
+from flow import create_batch
+from jit_nets import ScriptedODEfunc, check_parity
+from nets import AdaptedODENet, SparseODENet
+from registry import create_model
+
+
+def make_net(gmodel, net):
+    torch.manual_seed(0)
+    if net == "fully_connected":
+        diffeq = AdaptedODENet(gmodel.dim_latent, gmodel.dim_condition)
+    else:
+        diffeq = SparseODENet(gmodel.dim_latent, gmodel.dim_condition, gmodel.faithful_adjacency,
+                              torch.device("cpu"), sparse_mode=net)
+    diffeq.conditioned = create_batch(gmodel.sample, 16)[1]
+    return diffeq
+
+
+@pytest.mark.parametrize("name", ["state_space", "gaussian_bn"])
+@pytest.mark.parametrize("net", ["fully_connected", "dense", "sparse"])
+def test_parity(name, net):
+    deviations = check_parity(make_net(create_model(name), net))
+    assert set(deviations) == {"t=0.0", "t=0.3", "t=1.0"}
+
+
+def test_records_trajectory():
+    diffeq = make_net(create_model("state_space"), "dense")
+    func = ScriptedODEfunc(diffeq)
+    y, logp = torch.randn(16, diffeq.layers[-1]._hyper_gate.out_features), torch.zeros(16, 1)
+    diffeq.is_recording = True
+    func.before_odeint()
+    for t in (0.0, 0.5):
+        dy, _ = func(torch.tensor(t), (y, logp))
+    t, dx, x = diffeq.recorder.read()
+    assert list(t) == [0.0, 0.5]
+    assert torch.allclose(torch.from_numpy(dx[-1]), dy.detach())
+    assert torch.allclose(torch.from_numpy(x[-1]), y.detach())
@@ -0,0 +1,26 @@
+import torch
+
+from graph_model import GraphModel
+from models import AugmentedModel
+
+# flip has no fused density, the model falls back to the per-vertex path
+FLIP_GRAPH = {"V": ["sample1", "sample2", "observe3"],
+              "A": {"sample1": ["sample2"], "sample2": ["observe3"]},
+              "P": {"sample1": ["sample*", ["flip", 0.3]],
+                    "sample2": ["sample*", ["normal", "sample1", 1]],
+                    "observe3": ["observe*", ["normal", "sample2", 1], 2.0]},
+              "Y": {"observe3": 2.0}}
+
+
+def test_augment_without_density():
+    torch.manual_seed(0)
+    gmodel = GraphModel(FLIP_GRAPH)
+    assert gmodel.density is None
+    model = AugmentedModel(gmodel, [1])
+    assert model.density is None
+    x, y = model.sample_batch(5)
+    assert x.shape == (5, 3) and y.shape == (5, 1)
+    log_prior, log_likelihood = model.log_joint(x, y)
+    expected = gmodel.log_prior(x[:, :2]) + torch.distributions.Normal(0, 1).log_prob(x[:, 2])
+    assert torch.allclose(log_prior, expected)
+    assert torch.allclose(log_likelihood, gmodel.log_likelihood(x, y))
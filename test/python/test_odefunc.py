@@ -0,0 +1,72 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from lib.layers.odefunc import ODEfunc
+from nets import SparseODENet
+from registry import create_model
+
+
+class Linear(nn.Module):
+    """f(t, y) = y A^T, whose divergence is tr(A) everywhere."""
+
+    def __init__(self, A):
+        super(Linear, self).__init__()
+        self.A = A
+
+    def forward(self, t, y):
+        return y @ self.A.t()
+
+
+def divergence(func, y):
+    func.before_odeint()
+    _, minus_divergence = func(torch.tensor(0.), (y, torch.zeros(y.shape[0], 1).to(y)))
+    return -minus_divergence.detach().squeeze(1)
+
+
+@pytest.mark.parametrize("probe", ["gaussian", "rademacher", "orthogonal"])
+def test_multiprobe_unbiased(probe):
+    torch.manual_seed(0)
+    A = torch.randn(5, 5, dtype=torch.float64)
+    # every row draws its own probes
+    estimates = divergence(ODEfunc(Linear(A), num_probes=3, probe=probe),
+                           torch.randn(20000, 5, dtype=torch.float64))
+    error = (estimates.mean() - A.trace()).abs()
+    assert error < 4 * estimates.std() / len(estimates) ** 0.5
+
+
+def test_full_orthogonal_basis_is_exact():
+    torch.manual_seed(0)
+    A = torch.randn(5, 5, dtype=torch.float64)
+    estimates = divergence(ODEfunc(Linear(A), num_probes=5, probe="orthogonal"),
+                           torch.randn(10, 5, dtype=torch.float64))
+    assert torch.allclose(estimates, A.trace().expand(10), atol=1e-12)
+
+
+def test_divergence_variance():
+    torch.manual_seed(0)
+    A = torch.randn(5, 5, dtype=torch.float64)
+    func = ODEfunc(Linear(A), num_probes=4, probe="gaussian")
+    estimates = divergence(func, torch.randn(20000, 5, dtype=torch.float64))
+    assert func.divergence_variance() == pytest.approx(estimates.var().item(), rel=0.1)
+
+    assert ODEfunc(Linear(A), num_probes=1).divergence_variance() is None
+    func = ODEfunc(Linear(A), num_probes=4, probe="orthogonal")
+    divergence(func, torch.randn(10, 5, dtype=torch.float64))
+    assert func.divergence_variance() is None
+
+
+@pytest.mark.parametrize("name", ["synthetic-chain-30", "synthetic-grid-36"])
+def test_colored_divergence_is_exact(name):
+    torch.manual_seed(0)
+    gmodel = create_model(name)
+    diffeq = SparseODENet(gmodel.dim_latent, gmodel.dim_condition, gmodel.faithful_adjacency,
+                          torch.device("cpu")).double()
+    x, y = gmodel.sample_batch(8)
+    diffeq.conditioned = y.double()
+    x = x.double()
+    colored = divergence(ODEfunc(diffeq, divergence_fn="colored"), x)
+    exact = divergence(ODEfunc(diffeq, divergence_fn="brute_force"), x)
+    # fewer colors than dimensions, or the test would not say much
+    assert len(diffeq.coloring_probes()) < gmodel.dim_latent
+    assert torch.allclose(colored, exact, rtol=0, atol=1e-12)
@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from prefetch import BatchPrefetcher
+from registry import create_model
+
+
+def first_batches(seed, backend="process", num_workers=2, n=4):
+    with BatchPrefetcher(create_model("state_space"), 5, num_workers=num_workers,
+                         backend=backend, seed=seed) as batches:
+        return [next(batches) for _ in range(n)]
+
+
+def test_process_workers_are_seeded():
+    first, again, other = first_batches(0), first_batches(0), first_batches(1)
+    for (x, y), (x_, y_) in zip(first, again):
+        assert torch.equal(x, x_) and torch.equal(y, y_)
+    assert not torch.equal(first[0][0], other[0][0])
+    # workers are seeded with seed + index, consecutive batches alternate between them
+    assert not torch.equal(first[0][0], first[1][0])
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_close_stops_workers(backend):
+    gmodel = create_model("state_space")
+    batches = BatchPrefetcher(gmodel, 5, num_workers=2, queue_size=2, backend=backend, seed=0).start()
+    x, y = next(batches)
+    assert x.shape == (5, gmodel.dim_latent) and y.shape == (5, gmodel.dim_condition)
+    workers = list(batches._workers)
+    batches.close()
+    assert not any(w.is_alive() for w in workers)
+
+
+def test_process_backend_needs_fork(monkeypatch):
+    monkeypatch.setattr("torch.multiprocessing.get_all_start_methods", lambda: ["spawn"])
+    with pytest.raises(ValueError, match="fork"):
+        BatchPrefetcher(create_model("state_space"), 5, backend="process")
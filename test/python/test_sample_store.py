@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import torch
+
+from registry import create_model
+from sample_store import SampleStore
+
+
+def make_store(tmp_path, seed=0):
+    gmodel = create_model("state_space")
+    return gmodel, SampleStore(str(tmp_path), "state_space", seed, gmodel.dim_latent, gmodel.dim_condition)
+
+
+def test_fill_is_reproducible_and_keeps_random_stream(tmp_path):
+    gmodel, store = make_store(tmp_path / "a")
+    torch.manual_seed(1)
+    store.fill(gmodel, 50, chunk_size=20)
+    after_fill = torch.rand(3)
+    torch.manual_seed(1)
+    assert torch.equal(after_fill, torch.rand(3))
+
+    _, other = make_store(tmp_path / "b")
+    other.fill(gmodel, 50, chunk_size=20)
+    assert np.array_equal(store._open()[0], other._open()[0])
+    assert len(store) == 50
+
+
+def test_write_and_read_back(tmp_path):
+    gmodel, store = make_store(tmp_path)
+    assert not store.exists()
+    with pytest.raises(FileNotFoundError):
+        len(store)
+    x, y = np.random.rand(10, gmodel.dim_latent), np.random.rand(10, gmodel.dim_condition)
+    store.write(x, y)
+    assert store.exists() and len(store) == 10
+    xs, ys = store.minibatch(10, np.random.default_rng(0))
+    assert np.allclose(xs.numpy(), x.astype(np.float32)) and np.allclose(ys.numpy(), y.astype(np.float32))
+
+
+def test_batches_cover_epochs(tmp_path):
+    gmodel, store = make_store(tmp_path)
+    x = np.arange(10, dtype=np.float32)[:, None].repeat(gmodel.dim_latent, 1)
+    store.write(x, np.zeros([10, gmodel.dim_condition]))
+    batches = store.batches(3, seed=0)
+    # three batches per epoch of 10, each pair at most once per epoch
+    for _ in range(2):
+        seen = np.concatenate([next(batches)[0][:, 0].numpy() for _ in range(3)])
+        assert len(np.unique(seen)) == 9
+    first = [b[0] for b, _ in zip(store.batches(3, seed=0), range(2))]
+    again = [b[0] for b, _ in zip(store.batches(3, seed=0), range(2))]
+    assert all(torch.equal(a, b) for a, b in zip(first, again))
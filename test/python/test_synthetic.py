@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from registry import create_model
+from synthetic import from_name
+
+
+def test_from_name_options():
+    model = from_name("synthetic-random-20-fan_in=3-nonlinearity=linear-noise=0.25-obs_noise=1e-3")
+    assert model.dim_latent == 20
+    assert model.noise == 0.25 and model.obs_noise == 1e-3
+
+
+@pytest.mark.parametrize("option", ["noise=-0.5", "obs_noise=0", "noise=low"])
+def test_from_name_rejects_scales(option):
+    with pytest.raises(ValueError, match="has to be positive"):
+        from_name("synthetic-chain-4-" + option)
+
+
+def test_faithful_adjacency_chain():
+    model = create_model("synthetic-chain-4-obs_fraction=1.0")
+    # NaMI inverse of x0 -> x1 -> x2 -> x3 with x_i -> y_i, see test_adjacency
+    assert model.faithful_adjacency.pairs() == [[0, 0], [0, 1], [0, 4],
+                                                [1, 1], [1, 2], [1, 4], [1, 5],
+                                                [2, 2], [2, 3], [2, 4], [2, 5], [2, 6],
+                                                [3, 3], [3, 4], [3, 5], [3, 6], [3, 7]]
+    assert len(model.rand_adjacency) == len(model.faithful_adjacency)
+
+
+def test_faithful_adjacency_shape():
+    model = create_model("synthetic-random-50-fan_in=2")
+    assert model.faithful_adjacency.shape == (50, 50 + model.dim_condition)
+    x, y = model.sample_batch(4)
+    assert torch.isfinite(model.log_prior(x) + model.log_likelihood(x, y)).all()
@@ -0,0 +1,58 @@
+import torch
+
+from lib.layers.diffeq_layers.basic import ConcatSquashLinear, TimeConditioning
+from lib.layers.odefunc import ODEfunc
+from nets import AdaptedODENet
+
+
+def layers_and_reference(num_layers=3):
+    torch.manual_seed(0)
+    layers = [ConcatSquashLinear(4, 4) for _ in range(num_layers)]
+    reference = [ConcatSquashLinear(4, 4) for _ in range(num_layers)]
+    for a, b in zip(layers, reference):
+        b.load_state_dict(a.state_dict())
+    TimeConditioning(layers)
+    return layers, reference
+
+
+def test_matches_unfused_layers():
+    layers, reference = layers_and_reference()
+    x = torch.randn(5, 4)
+    for value in (0.0, 0.5, 0.5, 1.0):
+        t = torch.tensor(value)
+        for a, b in zip(layers, reference):
+            assert torch.allclose(a(t, x), b(t, x), atol=1e-6)
+
+
+def test_gradient_reaches_every_time_tensor():
+    layers, _ = layers_and_reference(1)
+    x = torch.randn(5, 4)
+    ts = [torch.tensor(0.5, requires_grad=True) for _ in range(2)]
+    for t in ts:
+        layers[0](t, x).sum().backward()
+    assert ts[0].grad is not None and ts[1].grad is not None
+    assert torch.allclose(ts[0].grad, ts[1].grad)
+
+
+def test_parameter_update_refreshes_gates():
+    layers, reference = layers_and_reference(1)
+    x, t = torch.randn(5, 4), torch.tensor(0.5)
+    layers[0](t, x)
+    with torch.no_grad():
+        for a, b in zip(layers[0].parameters(), reference[0].parameters()):
+            a.add_(1.0)
+            b.add_(1.0)
+    assert torch.allclose(layers[0](t, x), reference[0](t, x), atol=1e-6)
+
+
+def test_one_evaluation_per_odefunc_call():
+    torch.manual_seed(0)
+    net = AdaptedODENet(3, 2)
+    net.conditioned = torch.randn(5, 2)
+    func = ODEfunc(net)
+    func.before_odeint()
+    y, logp = torch.randn(5, 3), torch.zeros(5, 1)
+    # the layers of a call share the gates, every call has a new time tensor
+    for i, t in enumerate((0.1, 0.2, 0.2)):
+        func(torch.tensor(t), (y, logp))
+        assert net.time_conditioning.evaluations == i + 1